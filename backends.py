@@ -0,0 +1,292 @@
+"""backends.py: interchangeable execution backends for the period finding circuits"""
+
+import numpy as np
+
+from numbertheory import SMALL_PRIMES, gcd, isProbablePrime, pollardRho
+from simulator import Simulator
+
+
+class Backend(object):
+    """Takes a compiled program and a shot count and returns the measured bitstrings"""
+
+    name = None
+
+    # Whether run accepts a circuit.Circuit as well as a pyQuil Program
+    runs_circuits = False
+
+    # Whether periods come from shortcut_period without simulating anything,
+    # so N isn't held to what a simulator can handle
+    classical = False
+
+    # Whether PERIOD should run one round at a time through session, rather
+    # than the whole circuit through run
+    sequential = False
+
+    def run(self, program, shots=1):
+        # Returns an int8 array of shape (shots, len(ro))
+        raise NotImplementedError
+
+    def session(self, num_qubits):
+        # A stateful session whose run(circuit) continues from the state the
+        # last circuit left and returns the bits it measured. Its
+        # compile(circuit) gives something run takes in place of the circuit,
+        # for circuits that are run many times.
+        raise NotImplementedError("The {} backend has no sessions".format(self.name))
+
+    def shortcut_period(self, a, N, size, shots=1):
+        # Backends that can produce period finding samples without building
+        # the circuit override this; None means run the circuit as usual.
+        return None
+
+    def reseed(self, random_seed=None):
+        # Restarts the backend's random stream, fresh entropy if no seed
+        pass
+
+    def close(self):
+        # Releases whatever the backend holds on to, such as threads
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class QVMBackend(Backend):
+    """The remote QVM, connected on first use"""
+
+    name = "qvm"
+
+    def __init__(self, endpoint=None, random_seed=None):
+        self.endpoint = endpoint
+        self.random_seed = random_seed
+        self._qvm = None
+
+    def reseed(self, random_seed=None):
+        # The seed is handed over when connecting, so connect again
+        self.random_seed = random_seed
+        self._qvm = None
+
+    def run(self, program, shots=1):
+        if self._qvm is None:
+            from pyquil.api import QVMConnection
+            if self.endpoint is None:
+                self._qvm = QVMConnection(random_seed=self.random_seed)
+            else:
+                self._qvm = QVMConnection(self.endpoint, random_seed=self.random_seed)
+        return np.array(self._qvm.run(program, trials=shots), dtype=np.int8)
+
+
+class SimulatorBackend(Backend):
+    """The in-process statevector simulator
+
+    dtype, storage and threads are passed on to Simulator, so with a storage
+    directory the amplitudes are memory-mapped from a file there, and with
+    threads > 1 gates are applied on that many cores.
+    """
+
+    name = "simulator"
+    runs_circuits = True
+
+    def __init__(self, random_seed=None, dtype=np.complex128, storage=None, threads=1):
+        self.simulator = Simulator(random_seed, dtype, storage, threads=threads)
+
+    def run(self, program, shots=1):
+        return np.array(self.simulator.run(program, trials=shots), dtype=np.int8)
+
+    def session(self, num_qubits):
+        return self.simulator.session(num_qubits)
+
+    def reseed(self, random_seed=None):
+        self.simulator.rng = np.random.RandomState(random_seed)
+
+    def close(self):
+        self.simulator.close()
+
+
+class SequentialBackend(SimulatorBackend):
+    """The simulator, fed one period finding round at a time
+
+    Each round runs on a live session once the earlier bits are known, with
+    the phase corrections they call for applied directly. The rounds' UA
+    circuits don't depend on the bits and are reused across shots.
+    """
+
+    name = "sequential"
+    sequential = True
+
+
+class OracleBackend(Backend):
+    """Classical stand-in that samples the ideal period finding distribution
+
+    The order r of a mod N is computed classically and the measurements are
+    drawn from the exact output distribution of a noiseless period finding
+    circuit, see shor_samples. It only makes sense for PERIOD, and since
+    nothing is simulated it works for N far past BIT_LIMIT. Use it to exercise
+    the classical post-processing and its success statistics cheaply.
+    """
+
+    name = "oracle"
+    classical = True
+
+    def __init__(self, random_seed=None, window=32):
+        self.rng = np.random.RandomState(random_seed)
+        self.window = window
+
+    def run(self, program, shots=1):
+        raise NotImplementedError("The oracle backend can only sample PERIOD")
+
+    def reseed(self, random_seed=None):
+        self.rng = np.random.RandomState(random_seed)
+
+    def shortcut_period(self, a, N, size, shots=1):
+        return shor_samples(order(a, N), 1 << (2*size), shots, self.rng, self.window)
+
+
+# Registers up to this size get their whole output distribution tabulated
+EXACT_LIMIT = 1 << 20
+
+def shor_samples(r, Q, shots, rng, window=32):
+    # Measurements of a Q = 2**n period finding register when the order is r.
+    # Measuring the work register leaves x0 + j*r for j < M, where M is
+    # m+1 for s of the r cosets and m for the rest (m, s = divmod(Q, r)).
+    # After the QFT, y has probability F_M(r*y/Q) / (Q*M), where
+    # F_M(t) = sin(pi*M*t)**2 / sin(pi*t)**2 is the Fejer kernel: a peak of
+    # width about Q/(r*M) ~ 1 at each multiple of Q/r.
+    m, s = divmod(Q, r)
+    # k*Q and centers*r below must fit in int64, otherwise use Python ints
+    big = Q * r >= 1 << 63
+    if Q <= EXACT_LIMIT:
+        y = np.arange(Q)
+        p = (s*fejer(m + 1, r*y/Q) + (r - s)*fejer(m, r*y/Q)) / Q**2
+        return rng.choice(Q, size=shots, p=p/p.sum())
+
+    # Pick the coset size, then a peak, then an offset from the peak among
+    # the nearest 2*window+1 values, which hold nearly all of its weight
+    M = np.where(rng.random_sample(shots)*Q < s*(m + 1), m + 1, m)
+    k = random_below(r, shots, rng)
+    if big:
+        k = k.astype(object)
+    centers = (k*Q + r//2) // r
+    # How far the true peak k*Q/r is from its rounded center
+    error = (centers*r - k*Q).astype(np.float64) / r
+
+    window = min(window, (m - 1) // 2)
+    offsets = np.arange(-window, window + 1)
+    t = (offsets[None, :] + error[:, None]) * (r / Q)
+    weights = fejer(M[:, None], t)
+    cumulative = weights.cumsum(axis=1)
+    u = rng.random_sample(shots) * cumulative[:, -1]
+    picked = offsets[(cumulative < u[:, None]).sum(axis=1)]
+    if big:
+        picked = picked.astype(object)
+    return (centers + picked) % Q
+
+def fejer(M, t):
+    # sin(pi*M*t)**2 / sin(pi*t)**2, which is M**2 at integer t
+    M = np.asarray(M).astype(np.float64)
+    t = np.asarray(t, dtype=np.float64)
+    t = t - np.round(t)
+    denominator = np.sin(np.pi*t)**2
+    safe = np.where(denominator == 0, 1.0, denominator)
+    return np.where(denominator == 0, M**2, np.sin(np.pi*M*t)**2 / safe)
+
+def random_below(n, shots, rng):
+    # Uniform integers in [0, n), for n past what randint takes
+    if n < 1 << 62:
+        return rng.randint(n, size=shots).astype(np.int64)
+    words = (n.bit_length() + 64) // 32
+    return np.array([int.from_bytes(rng.bytes(4*words), "little") % n for _ in range(shots)],
+                    dtype=object)
+
+
+def order(a, N):
+    # Smallest r > 0 with a**r = 1 mod N. It divides the Carmichael function
+    # of N, so start there and strip prime factors while a**r stays 1.
+    if gcd(a, N) != 1:
+        raise ValueError("{} has no order mod {}".format(a, N))
+    r = carmichael(N)
+    for q in factorize(r):
+        while r % q == 0 and pow(a, r // q, N) == 1 % N:
+            r //= q
+    return r
+
+
+def carmichael(N):
+    # Smallest lambda with a**lambda = 1 mod N for every a coprime to N
+    result = 1
+    for p, e in factorize(N).items():
+        if p == 2 and e >= 3:
+            l = 2**(e - 2)
+        else:
+            l = p**(e - 1) * (p - 1)
+        result = result * l // gcd(result, l)
+    return result
+
+
+def factorize(n):
+    # Prime factorization of n as {p: e}, by trial division then Pollard's rho
+    factors = {}
+    for p in SMALL_PRIMES:
+        while n % p == 0:
+            factors[p] = factors.get(p, 0) + 1
+            n //= p
+    stack = [n] if n > 1 else []
+    while stack:
+        n = stack.pop()
+        if isProbablePrime(n):
+            factors[n] = factors.get(n, 0) + 1
+            continue
+        d = pollardRho(n)
+        stack.extend((d, n // d))
+    return factors
+
+
+BACKENDS = {
+    QVMBackend.name: QVMBackend,
+    SimulatorBackend.name: SimulatorBackend,
+    SequentialBackend.name: SequentialBackend,
+    OracleBackend.name: OracleBackend,
+}
+
+DEFAULT_BACKEND = SimulatorBackend.name
+
+_instances = {}
+
+def configure(backend, **options):
+    # Replaces the shared instance of a named backend with one built with
+    # options, for get_backend to hand out from then on
+    if backend in _instances:
+        _instances[backend].close()
+    _instances[backend] = BACKENDS[backend](**options)
+    return _instances[backend]
+
+def backend_class(backend=None):
+    # The class get_backend would hand out an instance of, without making one
+    if isinstance(backend, Backend):
+        return type(backend)
+    if backend is None:
+        backend = DEFAULT_BACKEND
+    if backend not in BACKENDS:
+        raise ValueError("Unknown backend {}, pick one of {}".format(
+            backend, ", ".join(sorted(BACKENDS))))
+    return BACKENDS[backend]
+
+def reseed_all():
+    # Gives every shared instance fresh entropy, for forked workers that
+    # would otherwise all inherit the parent's random streams
+    for backend in _instances.values():
+        backend.reseed()
+
+def get_backend(backend=None):
+    # Accepts a Backend, a registered name, or None for the default. Named
+    # backends are created once and shared, so connections stay warm.
+    if isinstance(backend, Backend):
+        return backend
+    cls = backend_class(backend)
+    if backend is None:
+        backend = DEFAULT_BACKEND
+    if backend not in _instances:
+        _instances[backend] = cls()
+    return _instances[backend]
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+"""batch.py: factor many N in one process pool, JSONL in and out
+
+Each input line is either a bare integer or an object with an "N" key, any
+other keys are copied to the output line. Workers live for the whole batch,
+so imports, backends and built circuits are paid for once per worker rather
+than once per N. Results are written as they finish, one line per input:
+
+    {"N": 21, "factors": [7, 3], "seconds": 4.2, "worker": 1234}
+
+A prime N gets "prime": true instead of factors, "factors": null means no
+attempt found enough periods, and an N that can't be run, or whose run
+raised, gets an "error" message.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import sys
+import time
+
+import shors
+from backends import BACKENDS, DEFAULT_BACKEND, get_backend, reseed_all
+from period import circuit_cache
+
+def initWorker(cacheDir, backend):
+    circuit_cache.directory = cacheDir
+    # Forked workers would otherwise all pick the same bases and draw the
+    # same measurements
+    random.seed()
+    reseed_all()
+    # Warm the backend before the first job arrives
+    get_backend(backend)
+
+def parseJob(line):
+    job = json.loads(line)
+    if not isinstance(job, dict):
+        job = {"N": job}
+    if not isinstance(job.get("N"), int):
+        raise ValueError("expected an integer N")
+    return job
+
+def readJobs(lines):
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield parseJob(line)
+        except ValueError as e:
+            yield {"input": line, "error": str(e)}
+
+def factorJob(args):
+    job, settings = args
+    if "error" in job:
+        return job
+
+    result = dict(job)
+    start = time.perf_counter()
+    try:
+        factors = shors.shors(job["N"], **settings)
+    except Exception as e:
+        # Reported on the job's own line, so the rest of the batch still runs
+        factors = e
+    result["seconds"] = round(time.perf_counter() - start, 6)
+    result["worker"] = os.getpid()
+    if isinstance(factors, Exception):
+        result["error"] = "{}: {}".format(type(factors).__name__, factors)
+    elif factors is False:
+        result["error"] = "N must be at least 3, and at most {} bits unless it factors classically".format(shors.BIT_LIMIT)
+    elif factors is not None and len(factors) == 1:
+        result["prime"] = True
+    else:
+        result["factors"] = factors
+    return result
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description='Factor a batch of integers with Shor\'s algorithm, JSONL in and out.')
+    parser.add_argument('input', nargs='?', default='-', help='File with one integer or JSON object per line, - for stdin')
+    parser.add_argument('-o', '--output', default='-', help='File to write results to, - for stdout')
+    parser.add_argument('-a', '--attempts', type=int, default=20, help='Number of quantum attemtps to perform')
+    parser.add_argument('-n', '--neighborhood', type=float, default=0.01, help='Neighborhood size for checking candidates (as percentage of N)')
+    parser.add_argument('-p', '--periods', type=int, default=2, help='Number of periods to get before determining least common multiple')
+    parser.add_argument('-s', '--shots', type=int, default=8, help='Number of measurements to take from each period finding circuit')
+    parser.add_argument('-b', '--backend', choices=sorted(BACKENDS), default=DEFAULT_BACKEND, help='Backend to run the period finding on')
+    parser.add_argument('-k', '--k-max', type=int, default=None, help='Drop rotations of 2pi/2^k with k above this (approximate QFT)')
+    parser.add_argument('-t', '--trial-bound', type=int, default=0, help='Try dividing N by everything up to this before going quantum')
+    parser.add_argument('-r', '--rho-budget', type=int, default=0, help='Steps of Pollard\'s rho to try before going quantum')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='Number of worker processes, defaults to one per core')
+    parser.add_argument('-c', '--cache-dir', default=None, help='Directory to keep built circuits in, shared by the workers')
+    return parser.parse_args()
+
+def main():
+    args = parseArgs()
+    settings = {
+        "attempts": args.attempts,
+        "neighborhood": args.neighborhood,
+        "numPeriods": args.periods,
+        "backend": args.backend,
+        "shots": args.shots,
+        "kMax": args.k_max,
+        "trialBound": args.trial_bound,
+        "rhoBudget": args.rho_budget,
+    }
+
+    inp = sys.stdin if args.input == '-' else open(args.input)
+    out = sys.stdout if args.output == '-' else open(args.output, 'w')
+
+    start = time.perf_counter()
+    count = 0
+    jobs = ((job, settings) for job in readJobs(inp))
+    with multiprocessing.Pool(args.workers, initWorker, (args.cache_dir, args.backend)) as pool:
+        for result in pool.imap_unordered(factorJob, jobs):
+            out.write(json.dumps(result) + "\n")
+            out.flush()
+            count += 1
+
+    print("Factored {} inputs in {:.3f}s".format(count, time.perf_counter() - start), file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+
+"""bench.py: wall time, peak memory and gate throughput of the circuit code
+
+Each benchmark builds (or runs) one piece of the pipeline for N of a given
+bit width and reports how many gates it produced. Time is the best of a few
+runs, peak memory comes from a separate run under tracemalloc so the tracing
+doesn't skew the timings. Every run is appended to a JSON lines history and
+compared against the latest earlier run of each benchmark:
+
+    python bench.py                  # default widths, compare and save
+    python bench.py -w 4 5 -k UA     # just UA at 4 and 5 bits
+    python bench.py --check          # exit 1 if anything got slower
+"""
+
+import argparse
+import json
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import shors
+from period import (QFT, PSIADDERMOD, CMULTMOD, UA, PERIOD, circuit_cache, cached_fused_circuit,
+                    cached_period_circuit, period_helper, period_circuit, period_layout)
+
+def semiprime(bits):
+    # Smallest product of two distinct odd primes with this bit length
+    N = (1 << (bits - 1)) | 1
+    while True:
+        p = next(d for d in range(3, N + 1, 2) if N % d == 0)
+        q = N // p
+        if q > p and all(q % d for d in range(3, int(q**0.5) + 1, 2)):
+            return N
+        N += 2
+
+def bench_qft(a, N, size):
+    return len(QFT(list(range(size+1))).instructions)
+
+def bench_psiaddermod(a, N, size):
+    layout = period_layout(size)
+    return len(PSIADDERMOD(layout.c1, layout.x[0], layout.b, a, N, layout.zero).instructions)
+
+def bench_cmultmod(a, N, size):
+    layout = period_layout(size)
+    return len(CMULTMOD(layout.c1, layout.x, layout.b, a, N, layout.zero).instructions)
+
+def bench_ua(a, N, size):
+    layout = period_layout(size)
+    return len(UA(layout.c1, layout.x, layout.b, a, N, layout.zero).instructions)
+
+def bench_period_helper(a, N, size):
+    return len(period_helper(a, N, size).instructions)
+
+def bench_period_circuit(a, N, size):
+    return len(period_circuit(a, N, size, optimized=True))
+
+def bench_period(a, N, size):
+    # One shot on the simulator, circuit build included
+    circuit_cache.clear()
+    cached_fused_circuit.cache_clear()
+    PERIOD(a, N, size, "simulator")
+    return len(cached_period_circuit(a, N, size, True))
+
+def bench_shors(a, N, size):
+    circuit_cache.clear()
+    cached_fused_circuit.cache_clear()
+    shors.shors(N, attempts = 20, neighborhood = 0.01, numPeriods = 1, backend = "simulator", shots = 8)
+    return None
+
+# name, function, largest bit width it's run at
+BENCHMARKS = [
+    ("QFT", bench_qft, 16),
+    ("PSIADDERMOD", bench_psiaddermod, 16),
+    ("CMULTMOD", bench_cmultmod, 12),
+    ("UA", bench_ua, 12),
+    ("period_helper", bench_period_helper, 8),
+    ("period_circuit", bench_period_circuit, 10),
+    ("PERIOD", bench_period, 5),
+    ("shors", bench_shors, 5),
+]
+
+def measure(function, a, N, size, repeats):
+    # Seeded so shors picks the same bases on every run
+    random.seed(0)
+    np.random.seed(0)
+    tracemalloc.start()
+    gates = function(a, N, size)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    best = float("inf")
+    for _ in range(repeats):
+        random.seed(0)
+        np.random.seed(0)
+        start = time.perf_counter()
+        function(a, N, size)
+        best = min(best, time.perf_counter() - start)
+
+    return {
+        "seconds": best,
+        "peak_bytes": peak,
+        "gates": gates,
+        "gates_per_sec": None if gates is None else gates / best,
+    }
+
+def run(widths, names=None, repeats=3):
+    results = []
+    for name, function, max_bits in BENCHMARKS:
+        if names and name not in names:
+            continue
+        for bits in widths:
+            if bits > max_bits:
+                continue
+            N = semiprime(bits)
+            result = {"name": name, "bits": bits, "N": N}
+            result.update(measure(function, 2, N, bits, repeats))
+            print(format_result(result), file=sys.stderr)
+            results.append(result)
+    return results
+
+def format_result(result):
+    rate = "" if result["gates_per_sec"] is None else "{:12.0f} gates/s".format(result["gates_per_sec"])
+    return "{:>15} {:3d} bits {:10.4f}s {:10.1f} MB{}".format(
+        result["name"], result["bits"], result["seconds"], result["peak_bytes"] / 2**20, rate)
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def load_history(path):
+    try:
+        with open(path) as f:
+            return [json.loads(line) for line in f if line.strip()]
+    except FileNotFoundError:
+        return []
+
+def compare(results, history, threshold):
+    # Returns the results more than threshold slower than the latest run of
+    # the same benchmark and width in history
+    before = {(r["name"], r["bits"]): r for record in history for r in record["results"]}
+    slower = []
+    print("{:>15} {:>4} {:>10} {:>10} {:>8}".format("benchmark", "bits", "before", "now", "change"))
+    for r in results:
+        old = before.get((r["name"], r["bits"]))
+        if old is None:
+            continue
+        change = r["seconds"] / old["seconds"] - 1
+        flag = ""
+        if change > threshold:
+            flag = "  SLOWER"
+            slower.append(r)
+        print("{:>15} {:4d} {:10.4f} {:10.4f} {:+7.1%}{}".format(
+            r["name"], r["bits"], old["seconds"], r["seconds"], change, flag))
+    return slower
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description='Benchmark circuit construction, simulation and factoring.')
+    parser.add_argument('-w', '--widths', type=int, nargs='+', default=[4, 5, 6, 8], help='Bit widths of N to run at')
+    parser.add_argument('-k', '--benchmarks', nargs='+', default=None, choices=[b[0] for b in BENCHMARKS], help='Only run these benchmarks')
+    parser.add_argument('-r', '--repeats', type=int, default=3, help='Timed runs per benchmark, the best is kept')
+    parser.add_argument('--history', default='bench_history.jsonl', help='JSON lines file of past runs')
+    parser.add_argument('--threshold', type=float, default=0.2, help='Relative slowdown that counts as a regression')
+    parser.add_argument('--no-save', action='store_true', help='Compare without adding this run to the history')
+    parser.add_argument('--check', action='store_true', help='Exit with status 1 if anything regressed')
+    return parser.parse_args()
+
+def main():
+    args = parseArgs()
+    results = run(args.widths, args.benchmarks, args.repeats)
+    record = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": results,
+    }
+
+    slower = []
+    history = load_history(args.history)
+    if history:
+        slower = compare(results, history, args.threshold)
+
+    if not args.no_save:
+        with open(args.history, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+    if args.check and slower:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""cache.py: bounded LRU cache of built circuits with an optional on-disk tier"""
+
+import os
+import zlib
+from collections import OrderedDict
+
+from circuit import Circuit, OPS
+
+# Part of every file name on disk, so circuits built by older code are never
+# loaded. Bump it whenever period.py or optimize.py change the circuit a key
+# builds. Changes to OPS, whose indices the files store, are picked up on
+# their own.
+CACHE_VERSION = 1
+CACHE_TAG = "v{}-{:08x}".format(CACHE_VERSION, zlib.crc32(",".join(OPS).encode()))
+
+
+class CircuitCache(object):
+    """Keeps the most recently used circuits in memory, and optionally on disk
+
+    Circuits are stored on disk in their compressed array form (Circuit.save),
+    one file per key. Parsing Quil text back is far slower than rebuilding the
+    circuit, so the text form isn't used.
+    """
+
+    def __init__(self, maxsize=16, directory=None):
+        self.maxsize = maxsize
+        self.directory = directory
+        self._circuits = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def get(self, key, build):
+        # Returns the circuit for key, calling build() only if no tier has it
+        if key in self._circuits:
+            self._circuits.move_to_end(key)
+            self.hits += 1
+            return self._circuits[key]
+
+        circuit = self._load(key)
+        if circuit is not None:
+            self.disk_hits += 1
+        else:
+            self.misses += 1
+            circuit = build()
+            self._store(key, circuit)
+
+        self._circuits[key] = circuit
+        while len(self._circuits) > self.maxsize:
+            self._circuits.popitem(last=False)
+        return circuit
+
+    def clear(self):
+        self._circuits.clear()
+
+    def __len__(self):
+        return len(self._circuits)
+
+    def __contains__(self, key):
+        return key in self._circuits
+
+    def _path(self, key):
+        name = "_".join(str(part) for part in key)
+        return os.path.join(self.directory, "{}.{}.npz".format(name, CACHE_TAG))
+
+    def _load(self, key):
+        if self.directory is None:
+            return None
+        try:
+            with open(self._path(key), "rb") as f:
+                return Circuit.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _store(self, key, circuit):
+        if self.directory is None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        # Write then rename so a concurrent reader never sees half a file
+        path = self._path(key)
+        tmp = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp, "wb") as f:
+            circuit.save(f)
+        os.replace(tmp, path)
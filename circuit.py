@@ -0,0 +1,156 @@
+"""circuit.py: compact struct-of-arrays format for the Fourier arithmetic circuits
+
+A Circuit keeps one row per operation in flat NumPy columns instead of one
+pyQuil object per gate:
+
+    op      uint8       index into OPS
+    qubits  int32 x 3   qubit indices, padded with -1
+    arg     int64       k of RK/CRK/CCRK, the phase of PHASE/CPHASE/CCPHASE in
+                        units of 2*pi/2**PHASE_BITS, or the ro index of a MEASURE
+    dagger  bool        whether the gate is inverted
+    cond    int32       ro index the op is conditioned on, or -1
+
+The builders in period.py yield ops as (name, arg, qubits, dagger, cond)
+tuples, which CircuitBuilder packs as they arrive. Conversion to a pyQuil
+Program only happens on demand, see period.circuit_program.
+"""
+
+import array
+
+import numpy as np
+
+OPS = ("I", "H", "X", "CNOT", "CCNOT", "SWAP", "RK", "CRK", "CCRK", "MEASURE",
+       "PHASE", "CPHASE", "CCPHASE")
+OPCODES = {name: i for i, name in enumerate(OPS)}
+
+# Gates that only put a phase on the all ones state of their qubits. They all
+# commute with each other and don't care about the order of their qubits.
+DIAGONAL = ("RK", "CRK", "CCRK", "PHASE", "CPHASE", "CCPHASE")
+
+# Fixed point precision of the PHASE family's arg, so sums of RK rotations
+# stay exact: RK(k) is a phase of 2**(PHASE_BITS - k)
+PHASE_BITS = 62
+
+MAX_QUBITS = 3
+_PAD = [(-1,)*(MAX_QUBITS - n) for n in range(MAX_QUBITS + 1)]
+
+
+class CircuitBuilder(object):
+    """Append-only buffers for building a Circuit one op at a time"""
+
+    def __init__(self):
+        self._op = array.array("B")
+        self._qubits = array.array("i")
+        self._arg = array.array("q")
+        self._dagger = array.array("B")
+        self._cond = array.array("i")
+
+    def append(self, name, arg, qubits, dagger, cond):
+        self._op.append(OPCODES[name])
+        self._qubits.extend(qubits)
+        self._qubits.extend(_PAD[len(qubits)])
+        self._arg.append(arg)
+        self._dagger.append(dagger)
+        self._cond.append(-1 if cond is None else cond)
+
+    def extend(self, ops):
+        for name, arg, qubits, dagger, cond in ops:
+            self.append(name, arg, qubits, dagger, cond)
+        return self
+
+    def __len__(self):
+        return len(self._op)
+
+    def build(self, num_qubits=None, num_bits=0):
+        # np.frombuffer wraps the buffers without copying them
+        qubits = np.frombuffer(self._qubits, dtype=np.int32).reshape(-1, MAX_QUBITS)
+        if num_qubits is None:
+            num_qubits = int(qubits.max()) + 1 if len(qubits) else 0
+        return Circuit(
+            np.frombuffer(self._op, dtype=np.uint8),
+            qubits,
+            np.frombuffer(self._arg, dtype=np.int64),
+            np.frombuffer(self._dagger, dtype=np.bool_),
+            np.frombuffer(self._cond, dtype=np.int32),
+            num_qubits, num_bits)
+
+
+class Circuit(object):
+    """An immutable circuit held as NumPy columns, see the module docstring"""
+
+    def __init__(self, op, qubits, arg, dagger, cond, num_qubits, num_bits=0):
+        self.op = op
+        self.qubits = qubits
+        self.arg = arg
+        self.dagger = dagger
+        self.cond = cond
+        self.num_qubits = num_qubits
+        self.num_bits = num_bits
+        for column in (op, qubits, arg, dagger, cond):
+            column.setflags(write=False)
+
+    @classmethod
+    def from_ops(cls, ops, num_qubits=None, num_bits=0):
+        return CircuitBuilder().extend(ops).build(num_qubits, num_bits)
+
+    def __len__(self):
+        return len(self.op)
+
+    @property
+    def nbytes(self):
+        return sum(c.nbytes for c in (self.op, self.qubits, self.arg, self.dagger, self.cond))
+
+    def take(self, rows):
+        # The ops picked out by rows, an index array or boolean mask
+        return Circuit(self.op[rows], self.qubits[rows], self.arg[rows], self.dagger[rows],
+                       self.cond[rows], self.num_qubits, self.num_bits)
+
+    def relabel(self, mapping, num_qubits=None):
+        # Moves qubit q to mapping[q]
+        mapping = np.asarray(mapping, dtype=np.int32)
+        qubits = np.where(self.qubits >= 0, mapping[self.qubits], -1).astype(np.int32)
+        if num_qubits is None:
+            num_qubits = int(mapping.max()) + 1 if len(mapping) else 0
+        return Circuit(self.op, qubits, self.arg, self.dagger, self.cond, num_qubits, self.num_bits)
+
+    def reversed(self):
+        # The inverse, for circuits without measurements
+        return Circuit(self.op[::-1], self.qubits[::-1], self.arg[::-1], ~self.dagger[::-1],
+                       self.cond[::-1], self.num_qubits, self.num_bits)
+
+    @classmethod
+    def concatenate(cls, circuits, num_qubits=None, num_bits=0):
+        circuits = list(circuits)
+        if not circuits:
+            return CircuitBuilder().build(num_qubits or 0, num_bits)
+        if num_qubits is None:
+            num_qubits = max((c.num_qubits for c in circuits), default=0)
+        columns = [np.concatenate([getattr(c, name) for c in circuits])
+                   for name in ("op", "qubits", "arg", "dagger", "cond")]
+        return cls(*columns, num_qubits, num_bits)
+
+    def ops(self):
+        # Back to (name, arg, qubits, dagger, cond) tuples
+        for code, qubits, arg, dagger, cond in zip(
+                self.op.tolist(), self.qubits.tolist(), self.arg.tolist(),
+                self.dagger.tolist(), self.cond.tolist()):
+            name = OPS[code]
+            yield (name, arg, tuple(q for q in qubits if q >= 0), dagger,
+                   None if cond < 0 else cond)
+
+    def counts(self):
+        # Number of ops of each type
+        found = np.bincount(self.op, minlength=len(OPS))
+        return {OPS[i]: int(n) for i, n in enumerate(found) if n}
+
+    def save(self, f):
+        np.savez_compressed(f, op=self.op, qubits=self.qubits, arg=self.arg,
+                            dagger=self.dagger, cond=self.cond,
+                            shape=np.array([self.num_qubits, self.num_bits]))
+
+    @classmethod
+    def load(cls, f):
+        with np.load(f) as data:
+            num_qubits, num_bits = data["shape"].tolist()
+            return cls(data["op"], data["qubits"], data["arg"], data["dagger"],
+                       data["cond"], num_qubits, num_bits)
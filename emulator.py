@@ -0,0 +1,174 @@
+"""emulator.py: runs the arithmetic blocks on basis states without a statevector
+
+On a basis input, every block in period.py and general_gates.py leaves each
+qubit either holding a classical bit or, inside a QFT, in the product state
+
+    (|0> + exp(2*pi*i * phase / 2**PHASE_BITS)|1>) / sqrt(2)
+
+So an input can be tracked as packed bits plus one phase per Fourier qubit,
+and a batch as NumPy arrays of those, with every gate a few vectorised
+integer operations:
+
+    H           turns a bit into a phase of 0 or pi and back
+    X, CNOT     flip bits, or negate a Fourier qubit's phase
+    CCNOT, SWAP
+    RK, CRK,    add to the phase of their one Fourier qubit (or the global
+    CCRK, PHASE phase) wherever their classical controls are all set
+    family
+
+Phases are exact fixed point, like the PHASE family's arg. Which qubits are
+Fourier doesn't depend on the input, so a gate that would entangle two
+Fourier qubits is rejected up front. An H that meets a phase other than 0
+or pi, as after an approximate QFT, marks that input as no longer a basis
+state in ok rather than failing the batch.
+"""
+
+from collections import namedtuple
+
+import numpy as np
+
+from pyquil.quilbase import Gate
+
+from circuit import Circuit, DIAGONAL
+from optimize import phase_of, FULL_TURN
+
+HALF_TURN = FULL_TURN >> 1
+
+# bits packs qubit q of each input into bit q, phases maps each qubit left in
+# the Fourier basis to its phases, global_phase is the phase picked up along
+# the way and ok is False for inputs that stopped being basis states
+Emulated = namedtuple("Emulated", ["bits", "phases", "global_phase", "ok"])
+
+# Inputs are run this many at a time, so the working arrays stay in cache
+CHUNK = 1 << 14
+
+def emulate(ops, inputs, chunk=CHUNK):
+    # Runs ops (tuples, a Circuit, or a Program through program_ops) on the
+    # basis states whose packed bits are inputs
+    if isinstance(ops, Circuit):
+        ops = ops.ops()
+    ops = list(ops)
+    inputs = np.asarray(inputs, dtype=np.int64)
+    parts = [emulate_chunk(ops, inputs[i:i+chunk]) for i in range(0, len(inputs), chunk)]
+    if not parts:
+        return emulate_chunk(ops, inputs)
+    return Emulated(np.concatenate([p.bits for p in parts]),
+                    {q: np.concatenate([p.phases[q] for p in parts]) for q in parts[0].phases},
+                    np.concatenate([p.global_phase for p in parts]),
+                    np.concatenate([p.ok for p in parts]))
+
+def emulate_chunk(ops, inputs):
+    bits = np.array(inputs, dtype=np.int64)
+    phases = {}
+    global_phase = np.zeros(len(bits), dtype=np.int64)
+    ok = np.ones(len(bits), dtype=np.bool_)
+
+    def bit(q):
+        return (bits >> q) & 1
+
+    def flip(q, where):
+        # X where the controls are set, where is 0 or 1 per input, or None
+        # for no controls
+        nonlocal global_phase
+        if q in phases:
+            flipped = -phases[q] & (FULL_TURN - 1)
+            if where is None:
+                global_phase = (global_phase + phases[q]) & (FULL_TURN - 1)
+                phases[q] = flipped
+            else:
+                global_phase = (global_phase + where*phases[q]) & (FULL_TURN - 1)
+                phases[q] = np.where(where == 1, flipped, phases[q])
+        elif where is None:
+            bits[...] ^= 1 << q
+        else:
+            bits[...] ^= where << q
+
+    def controls(qubits):
+        where = None
+        for q in qubits:
+            if q in phases:
+                raise ValueError("qubit {} is in the Fourier basis and can't control a flip".format(q))
+            where = bit(q) if where is None else where & bit(q)
+        return where
+
+    for name, arg, qubits, dagger, cond in ops:
+        if cond is not None or name == "MEASURE":
+            raise ValueError("the emulator only runs unitary blocks, not {}".format(name))
+        if name == "I":
+            continue
+        elif name == "H":
+            q = qubits[0]
+            if q in phases:
+                phase = phases.pop(q)
+                ok &= (phase == 0) | (phase == HALF_TURN)
+                bits |= (phase == HALF_TURN).astype(np.int64) << q
+            else:
+                phases[q] = bit(q) * HALF_TURN
+                bits &= ~(1 << q)
+        elif name in ("X", "CNOT", "CCNOT"):
+            flip(qubits[-1], controls(qubits[:-1]))
+        elif name == "SWAP":
+            l, r = qubits
+            if l in phases or r in phases:
+                # Swapping also swaps which qubit is Fourier
+                moved = {r: phases.pop(l)} if l in phases else {}
+                if r in phases:
+                    moved[l] = phases.pop(r)
+                phases.update(moved)
+            swapped = bit(l) ^ bit(r)
+            bits ^= (swapped << l) | (swapped << r)
+        elif name in DIAGONAL:
+            fourier = [q for q in qubits if q in phases]
+            if len(fourier) > 1:
+                raise ValueError("{} on Fourier qubits {} would entangle them".format(name, fourier))
+            where = controls([q for q in qubits if q not in phases])
+            amount = phase_of(name, arg, dagger)
+            if where is not None:
+                amount = where * amount
+            if fourier:
+                phases[fourier[0]] = (phases[fourier[0]] + amount) & (FULL_TURN - 1)
+            else:
+                global_phase = (global_phase + amount) & (FULL_TURN - 1)
+        else:
+            raise ValueError("the emulator can't run {}".format(name))
+    return Emulated(bits, phases, global_phase, ok)
+
+def pack(values, reg, bits=0):
+    # Writes values into the qubits of reg, qubit 0 of reg least significant
+    bits = np.array(bits, dtype=np.int64) | np.zeros(len(values), dtype=np.int64)
+    values = np.asarray(values, dtype=np.int64)
+    for i, q in enumerate(reg):
+        bits |= ((values >> i) & 1) << q
+    return bits
+
+def unpack(bits, reg):
+    # The values held in reg
+    values = np.zeros(len(bits), dtype=np.int64)
+    for i, q in enumerate(reg):
+        values |= ((bits >> q) & 1) << i
+    return values
+
+def program_ops(program, index=None):
+    # Op tuples for the gates of a pyQuil Program, such as the blocks in
+    # general_gates.py. index maps qubits (placeholders included) to
+    # integers, by default their own index.
+    def number(q):
+        return q.index if index is None else index[q]
+
+    for inst in program.instructions:
+        if not isinstance(inst, Gate):
+            raise ValueError("the emulator only runs gates, not {}".format(inst))
+        name = inst.name
+        modifiers = list(inst.modifiers)
+        dagger = modifiers.count("DAGGER") % 2 == 1
+        name = "C"*modifiers.count("CONTROLLED") + name
+        name = {"CX": "CNOT", "CCX": "CCNOT"}.get(name, name)
+        if name in ("RK", "CRK", "CCRK"):
+            arg = int(inst.params[0])
+        elif name in ("PHASE", "CPHASE", "CCPHASE"):
+            arg = int(round(inst.params[0] / (2*np.pi) * FULL_TURN)) % FULL_TURN
+        elif inst.params:
+            raise ValueError("the emulator can't run {}".format(inst))
+        else:
+            arg = 0
+        yield (name, arg, tuple(number(q) for q in inst.qubits), dagger, None)
@@ -0,0 +1,64 @@
+"""fidelity.py: what the approximate QFT cutoff k_max costs
+
+Runs the exact and approximate versions of a block on the simulator from the
+same basis inputs and averages the overlap |<exact|approx>|**2 of the final
+states. python fidelity.py N prints gate counts and fidelities per cutoff.
+"""
+
+import itertools
+import sys
+
+import numpy as np
+
+from circuit import Circuit
+from period import period_layout, qft_gates, ua_gates, write_in_gates
+from resources import estimate
+from simulator import Simulator
+
+def state_fidelity(a, b):
+    return abs(np.vdot(a, b))**2
+
+def mean_fidelity(build, inputs, num_qubits, k_max):
+    # build(x, k_max) yields the ops for input x
+    simulator = Simulator()
+    total = 0.0
+    for x in inputs:
+        exact = simulator.wavefunction(Circuit.from_ops(build(x, None), num_qubits))
+        approx = simulator.wavefunction(Circuit.from_ops(build(x, k_max), num_qubits))
+        total += state_fidelity(exact, approx)
+    return total / len(inputs)
+
+def qft_fidelity(n, k_max, samples=16, random_seed=None):
+    # Average fidelity of QFT on n qubits over random basis inputs
+    reg = list(range(n))
+    rng = np.random.RandomState(random_seed)
+    inputs = rng.randint(2**n, size=samples)
+    build = lambda x, k: itertools.chain(write_in_gates(int(x), reg), qft_gates(reg, k))
+    return mean_fidelity(build, inputs, n, k_max)
+
+def ua_fidelity(a, N, size, k_max, samples=4, random_seed=None):
+    # Average fidelity of UA, with its control on, over random x < N
+    c1, zero, x, b = period_layout(size)
+    rng = np.random.RandomState(random_seed)
+    inputs = rng.randint(N, size=samples)
+    def build(value, k):
+        return itertools.chain([("X", 0, (c1,), False, None)],
+                               write_in_gates(int(value), x),
+                               ua_gates(c1, x, b, a, N, zero, k))
+    return mean_fidelity(build, inputs, 2*size+3, k_max)
+
+def main():
+    # python fidelity.py N [a]
+    N = int(sys.argv[1])
+    a = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+    size = N.bit_length()
+    print("{:>6} {:>10} {:>10} {:>10}".format("k_max", "gates", "QFT", "UA"))
+    for k_max in range(1, size+3):
+        gates = sum(estimate(a, N, size, k_max=k_max).gates.values())
+        print("{:>6} {:>10} {:>10.6f} {:>10.6f}".format(
+            k_max, gates, qft_fidelity(2*size, k_max, random_seed=0),
+            ua_fidelity(a, N, size, k_max, random_seed=0)))
+    print("{:>6} {:>10}".format("exact", sum(estimate(a, N, size).gates.values())))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""fuse.py: gate fusion pass that packs runs of small gates into dense unitaries
+
+The period finding circuits are long chains of one to three qubit gates, and
+a statevector backend pays one pass over the amplitudes for each. The pass
+collects neighbouring gates whose qubits together number at most max_qubits
+into blocks, multiplies each block out into one 2**k x 2**k unitary, and
+emits a single FUSED op for it:
+
+    ("FUSED", i, qubits, False, None)    # matrices[i] on qubits, the first
+                                         # qubit most significant
+
+Blocks on disjoint qubits are grown side by side, so a gate only closes the
+blocks it overlaps. Measurements and classically conditioned gates are left
+as they are and close any block on their qubits. Blocks of a single gate
+keep the gate.
+"""
+
+import sys
+from collections import namedtuple
+
+import numpy as np
+
+from simulator import apply_matrix, circuit_matrix
+
+# Largest number of qubits a fused block may act on
+FUSION_QUBITS = 4
+
+Report = namedtuple("Report", ["ops", "blocks", "fused_ops", "after"])
+
+
+class FusedCircuit(object):
+    """A circuit's ops with fused blocks, see the module docstring
+
+    Looks like a Circuit to Simulator.compile, ops() yields the ops with
+    FUSED ops in place of the blocks.
+    """
+
+    def __init__(self, items, matrices, num_qubits, num_bits=0):
+        self.items = items
+        self.matrices = matrices
+        self.num_qubits = num_qubits
+        self.num_bits = num_bits
+
+    def __len__(self):
+        return len(self.items)
+
+    def ops(self):
+        return iter(self.items)
+
+
+def block_shape(ops, qubits):
+    # The block's ops with qubits as positions in the block, which is all
+    # its unitary depends on
+    position = {q: i for i, q in enumerate(qubits)}
+    return (len(qubits),) + tuple((name, arg, tuple(position[q] for q in op_qubits), dagger)
+                                  for name, arg, op_qubits, dagger, _ in ops)
+
+def block_matrix(shape):
+    # The unitary of a block_shape, built by applying its ops to the identity
+    k = shape[0]
+    unitary = np.eye(2**k, dtype=np.complex128).reshape((2,)*(2*k))
+    for name, arg, positions, dagger in shape[1:]:
+        unitary = apply_matrix(unitary, circuit_matrix(name, arg, dagger), list(positions))
+    return unitary.reshape(2**k, 2**k)
+
+def fuse_ops(ops, max_qubits=FUSION_QUBITS):
+    # Returns the fused ops and the matrices their FUSED ops index into.
+    # open_blocks maps each qubit in an open block to that block, a
+    # [qubits, ops] pair. Open blocks never share qubits, so they commute
+    # and can be closed in any order. The arithmetic repeats the same
+    # blocks on different qubits, so each distinct unitary is built once.
+    out = []
+    matrices = []
+    index_of = {}
+    open_blocks = {}
+
+    def close(block):
+        qubits, block_ops = block
+        for q in qubits:
+            del open_blocks[q]
+        if len(block_ops) == 1:
+            out.append(block_ops[0])
+        else:
+            shape = block_shape(block_ops, qubits)
+            if shape not in index_of:
+                index_of[shape] = len(matrices)
+                matrices.append(block_matrix(shape))
+            out.append(("FUSED", index_of[shape], tuple(qubits), False, None))
+
+    def overlapping(qubits):
+        blocks = []
+        for q in qubits:
+            block = open_blocks.get(q)
+            if block is not None and all(block is not b for b in blocks):
+                blocks.append(block)
+        return blocks
+
+    for op in ops:
+        name, arg, qubits, dagger, cond = op
+        blocks = overlapping(qubits)
+        if name == "MEASURE" or cond is not None:
+            for block in blocks:
+                close(block)
+            out.append(op)
+            continue
+        merged = [q for block in blocks for q in block[0]]
+        merged += [q for q in qubits if q not in merged]
+        if len(merged) > max_qubits:
+            for block in blocks:
+                close(block)
+            merged, blocks = list(qubits), []
+        # Blocks join in the order they were opened, keeping their ops in
+        # circuit order relative to each other's qubits
+        block = [merged, [op for b in blocks for op in b[1]] + [op]]
+        for q in merged:
+            open_blocks[q] = block
+    for block in list({id(b): b for b in open_blocks.values()}.values()):
+        close(block)
+    return out, matrices
+
+def fuse(circuit, max_qubits=FUSION_QUBITS):
+    # Returns the FusedCircuit and a Report of what was fused
+    items, matrices = fuse_ops(circuit.ops(), max_qubits)
+    fused = FusedCircuit(items, matrices, circuit.num_qubits, circuit.num_bits)
+    blocks = sum(1 for op in items if op[0] == "FUSED")
+    fused_ops = len(circuit) - (len(items) - blocks)
+    return fused, Report(len(circuit), blocks, fused_ops, len(items))
+
+def format_report(report):
+    lines = [
+        "{:>16} {:>10}".format("ops before", report.ops),
+        "{:>16} {:>10}".format("fused blocks", report.blocks),
+        "{:>16} {:>10}".format("ops in blocks", report.fused_ops),
+        "{:>16} {:>10}".format("ops after", report.after),
+    ]
+    if report.blocks:
+        lines.append("{:>16} {:>10.2f}".format("ops per block", report.fused_ops / report.blocks))
+    return "\n".join(lines)
+
+def main():
+    # python fuse.py N [a] [max_qubits]
+    from period import cached_period_circuit
+    N = int(sys.argv[1])
+    a = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+    max_qubits = int(sys.argv[3]) if len(sys.argv) > 3 else FUSION_QUBITS
+    _, report = fuse(cached_period_circuit(a, N, N.bit_length(), True), max_qubits)
+    print(format_report(report))
+
+if __name__ == "__main__":
+    main()
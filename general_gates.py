@@ -7,10 +7,9 @@ from IPython import embed
 
 from pyquil.quil import Program, address_qubits
 from pyquil.quilatom import QubitPlaceholder
-from pyquil.api import QVMConnection
 from pyquil.gates import X, I, H, CNOT, CCNOT, MEASURE
 
-qvm = QVMConnection()
+from backends import get_backend
 
 #NOTE: This code is inneficient, and now depreciated in preference of the code found in 
 def REVERSE(p):
@@ -152,7 +151,7 @@ def write_in(val, reg):
 
     return p
 
-def read_out(p, reg):
+def read_out(p, reg, backend=None):
 
     p = Program(p)
     ro = p.declare('ro', 'BIT', len(reg))
@@ -160,8 +159,10 @@ def read_out(p, reg):
     for i in range(len(reg)):
         p += MEASURE(reg[i], ro[i])
 
-    p = address_qubits(p)
-    result = qvm.run(p)
+    # Programs built on concrete qubit indices are already addressed
+    if any(isinstance(q, QubitPlaceholder) for q in reg):
+        p = address_qubits(p)
+    result = get_backend(backend).run(p)
 
     outp = 0
     for i in range(len(result[0])):
@@ -171,18 +172,17 @@ def read_out(p, reg):
 
 
 def lookup_append(qbit_lookup, reg, name):
+    # Names the qubits of reg name_0, name_1, ... for pretty_print
     for i in range(len(reg)):
-        qbit_id = repr(reg[i]).split()[1][:-1]
-        qbit_lookup[qbit_id] = "{}_{}".format(name, i)
+        qbit_lookup[reg[i]] = "{}_{}".format(name, i)
 
-def pretty_print(qbit_lookup):
+def pretty_print(p, qbit_lookup):
+    # Unaddressed placeholders print as {q<id>}
+    names = {"{{{}}}".format(q): name for q, name in qbit_lookup.items()}
     pp = ""
-    for line in str(Program(ADDER(c,a,b))).splitlines():
+    for line in str(p).splitlines():
         for item in line.split():
-            check = item[2:][:-1]
-            if check.isdigit():
-                item = qbit_lookup[check]
-            pp += item+" "
+            pp += names.get(item, item)+" "
         pp += "\n"
 
     print(pp)
@@ -227,7 +227,7 @@ def main():
     #lookup_append(qbit_lookup, a, "a")
     #lookup_append(qbit_lookup, b, "b")
     #lookup_append(qbit_lookup, c, "c")
-    #pretty_print(qbit_lookup)
+    #pretty_print(ADDER(c, a, b), qbit_lookup)
 
     embed(colors="Neutral")
 
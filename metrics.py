@@ -0,0 +1,170 @@
+"""metrics.py: timing spans and counters for the factoring pipeline
+
+Nothing is recorded until enable() is called, so the hooks in shors.py and
+period.py cost one global lookup each when switched off. Once enabled,
+
+    with span("backend.run", shots=8): ...      # or @timed("PERIOD")
+    count("gates", len(circuit))
+
+collect into the active Recorder, which can print a summary, write a Chrome
+trace event file (open it in chrome://tracing or ui.perfetto.dev), or hand
+every finished span to a sink callable as it happens. Spans and counters are
+per process; workers of shorsParallel and batch.py keep their own.
+"""
+
+import cProfile
+import functools
+import json
+import os
+import sys
+import time
+import tracemalloc
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager, nullcontext
+
+
+class Recorder(object):
+    """Collects finished spans and counter totals
+
+    sink, if given, is called with each span's record as it finishes. With
+    memory=True, tracemalloc runs for the lifetime of the recorder and each
+    span also records the traced memory in use and the peak so far.
+    """
+
+    def __init__(self, sink=None, memory=False):
+        self.sink = sink
+        self.memory = memory
+        self.spans = []
+        self.counters = defaultdict(int)
+        self._depth = 0
+        self._origin = time.perf_counter()
+        if memory:
+            tracemalloc.start()
+
+    @contextmanager
+    def span(self, name, **tags):
+        start = time.perf_counter()
+        self._depth += 1
+        try:
+            yield
+        finally:
+            self._depth -= 1
+            record = {
+                "name": name,
+                "start": start - self._origin,
+                "seconds": time.perf_counter() - start,
+                "depth": self._depth,
+                "pid": os.getpid(),
+            }
+            if tags:
+                record["tags"] = tags
+            if self.memory:
+                record["bytes"], record["peak_bytes"] = tracemalloc.get_traced_memory()
+            self.spans.append(record)
+            if self.sink is not None:
+                self.sink(record)
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def close(self):
+        if self.memory:
+            tracemalloc.stop()
+
+    def summary(self):
+        # Calls, total seconds and, with memory on, the highest peak seen at
+        # the end of a span, per span name in order of first appearance
+        totals = OrderedDict()
+        for record in sorted(self.spans, key=lambda r: r["start"]):
+            total = totals.setdefault(record["name"], {"calls": 0, "seconds": 0.0})
+            total["calls"] += 1
+            total["seconds"] += record["seconds"]
+            if "peak_bytes" in record:
+                total["peak_bytes"] = max(total.get("peak_bytes", 0), record["peak_bytes"])
+        return {"spans": totals, "counters": dict(self.counters)}
+
+    def format_summary(self):
+        summary = self.summary()
+        lines = ["{:>24} {:>8} {:>12} {:>10}".format("span", "calls", "seconds", "peak MB")]
+        for name, total in summary["spans"].items():
+            peak = "" if "peak_bytes" not in total else "{:10.1f}".format(total["peak_bytes"] / 2**20)
+            lines.append("{:>24} {:8d} {:12.4f} {}".format(name, total["calls"], total["seconds"], peak))
+        for name, value in sorted(summary["counters"].items()):
+            lines.append("{:>24} {:8}".format(name, value))
+        return "\n".join(lines)
+
+    def write_trace(self, path):
+        # Chrome trace event format, times in microseconds
+        events = []
+        for record in self.spans:
+            events.append({
+                "name": record["name"],
+                "ph": "X",
+                "ts": record["start"] * 1e6,
+                "dur": record["seconds"] * 1e6,
+                "pid": record["pid"],
+                "tid": 0,
+                "args": record.get("tags", {}),
+            })
+        end = max((r["start"] + r["seconds"] for r in self.spans), default=0.0)
+        for name, value in self.counters.items():
+            events.append({"name": name, "ph": "C", "ts": end * 1e6, "pid": os.getpid(),
+                           "args": {name: value}})
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events}, f)
+
+
+_recorder = None
+
+def enable(sink=None, memory=False):
+    # Starts recording into a fresh Recorder, which is returned
+    global _recorder
+    disable()
+    _recorder = Recorder(sink, memory)
+    return _recorder
+
+def disable():
+    global _recorder
+    if _recorder is not None:
+        _recorder.close()
+    _recorder = None
+
+def recorder():
+    return _recorder
+
+def span(name, **tags):
+    if _recorder is None:
+        return nullcontext()
+    return _recorder.span(name, **tags)
+
+def count(name, n=1):
+    if _recorder is not None:
+        _recorder.count(name, n)
+
+def timed(name):
+    # Decorator that wraps every call of the function in a span
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _recorder is None:
+                return function(*args, **kwargs)
+            with _recorder.span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+@contextmanager
+def profiled(path=None):
+    # Runs the block under cProfile, dumping pstats to path or printing the
+    # top functions by cumulative time to stderr
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield profile
+    finally:
+        profile.disable()
+        if path is not None:
+            profile.dump_stats(path)
+        else:
+            import pstats
+            pstats.Stats(profile, stream=sys.stderr).sort_stats("cumulative").print_stats(25)
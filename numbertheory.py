@@ -0,0 +1,71 @@
+"""numbertheory.py: the integer arithmetic shared by shors.py and the oracle backend"""
+
+SMALL_PRIMES = [2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37]
+
+# Greatest Common Divisor
+def gcd(a, b):
+    while b != 0:
+        tA = a % b
+        a = b
+        b = tA
+
+    return a
+
+# a ** exp % mod, by repeated squaring
+def modExp(a, exp, mod):
+    fx = 1
+    while exp > 0:
+        if (exp & 1) == 1:
+            fx = fx * a % mod
+        a = (a * a) % mod
+        exp = exp >> 1
+
+    return fx
+
+# Miller-Rabin with the first 12 primes as witnesses, which is exact for
+# N < 3.3 * 10**24 and a probable prime test past that
+def isProbablePrime(N):
+    if N < 2:
+        return False
+    for p in SMALL_PRIMES:
+        if N % p == 0:
+            return N == p
+
+    d = N - 1
+    s = 0
+    while d % 2 == 0:
+        d //= 2
+        s += 1
+
+    for a in SMALL_PRIMES:
+        x = modExp(a, d, N)
+        if x == 1 or x == N - 1:
+            continue
+        for _ in range(s - 1):
+            x = x * x % N
+            if x == N - 1:
+                break
+        else:
+            return False
+
+    return True
+
+# Pollard's rho, giving up after budget steps in total, or only once it
+# finds a factor if budget is None
+def pollardRho(N, budget = None):
+    c = 1
+    while budget is None or budget > 0:
+        x = y = 2
+        d = 1
+        while d == 1 and (budget is None or budget > 0):
+            x = (x * x + c) % N
+            y = (y * y + c) % N
+            y = (y * y + c) % N
+            d = gcd(abs(x - y), N)
+            if budget is not None:
+                budget -= 1
+        if 1 < d < N:
+            return d
+        c += 1
+
+    return None
@@ -0,0 +1,153 @@
+"""optimize.py: peephole pass that shrinks the period finding circuits
+
+The Fourier arithmetic leaves a lot of slack in the generated circuits. Every
+CMULTMOD ends with REVERSE(QFT(b)) and the next block starts with QFT(b), the
+adders stack up rotations on the same qubits, and the uncompute halves of
+PSIADDERMOD undo gates the compute halves just applied. The pass makes one
+sweep over the ops and
+
+    - sums the phases of diagonal gates (RK, CRK, CCRK and the PHASE family)
+      on the same qubits, across any ops that commute with them, into one
+      rotation, dropping it if the phases cancel
+    - cancels adjacent pairs of the self inverse gates (H, X, CNOT, CCNOT,
+      SWAP), which in turn exposes more rotations to merge
+
+The result is the same unitary, up to rotations smaller than 2*pi/2**62.
+"""
+
+import sys
+from collections import OrderedDict, namedtuple
+
+from circuit import Circuit, DIAGONAL, PHASE_BITS
+
+SELF_INVERSE = ("H", "X", "CNOT", "CCNOT", "SWAP")
+
+FULL_TURN = 1 << PHASE_BITS
+
+Report = namedtuple("Report", ["before", "after"])
+
+def phase_of(name, arg, dagger):
+    # Phase of a diagonal op in units of 2*pi/2**PHASE_BITS
+    if name in ("RK", "CRK", "CCRK"):
+        phase = 1 << (PHASE_BITS - arg) if arg <= PHASE_BITS else 0
+    else:
+        phase = arg
+    return (-phase if dagger else phase) % FULL_TURN
+
+def phase_op(phase, qubits, cond):
+    # Fewest frills diagonal op for phase, or None if it is the identity
+    if phase == 0:
+        return None
+    controls = "C"*(len(qubits) - 1)
+    for value, dagger in ((phase, False), (FULL_TURN - phase, True)):
+        if value & (value - 1) == 0:
+            k = PHASE_BITS - (value.bit_length() - 1)
+            return (controls + "RK", k, qubits, dagger, cond)
+    return (controls + "PHASE", phase, qubits, False, cond)
+
+def same_gate(a, b):
+    # Whether self inverse ops a and b are the same gate on the same qubits
+    if a[0] != b[0] or a[4] is not None or b[4] is not None:
+        return False
+    if a[0] == "CCNOT":
+        return set(a[2][:2]) == set(b[2][:2]) and a[2][2] == b[2][2]
+    if a[0] == "SWAP":
+        return set(a[2]) == set(b[2])
+    return a[2] == b[2]
+
+def optimize_ops(ops):
+    # Returns the optimized list of (name, arg, qubits, dagger, cond) ops.
+    # Emitted ops live in out, with None where one was cancelled, and
+    # stacks[q] holds the positions in out of the live ops on qubit q.
+    # Diagonal ops wait in pending, keyed by their qubits and condition,
+    # until a gate that doesn't commute with them touches one of their qubits.
+    out = []
+    stacks = {}
+    pending = OrderedDict()
+
+    def emit(op):
+        for q in op[2]:
+            stacks.setdefault(q, []).append(len(out))
+        out.append(op)
+
+    def hold(name, arg, qubits, dagger, cond):
+        key = (tuple(sorted(qubits)), cond)
+        pending[key] = (pending.get(key, 0) + phase_of(name, arg, dagger)) % FULL_TURN
+
+    def flush(qubits, bit=None):
+        for key in [key for key in pending
+                    if (bit is not None and key[1] == bit) or any(q in key[0] for q in qubits)]:
+            op = phase_op(pending.pop(key), key[0], key[1])
+            if op is not None:
+                emit(op)
+
+    def top(q):
+        stack = stacks.get(q)
+        return stack[-1] if stack else None
+
+    def unemit(i):
+        for q in out[i][2]:
+            stacks[q].pop()
+        out[i] = None
+
+    def reabsorb(qubits):
+        # After a cancellation, diagonal ops that are now the last op on all
+        # their qubits can go back to pending and merge with what follows
+        todo = list(qubits)
+        while todo:
+            i = top(todo.pop())
+            if i is None or out[i][0] not in DIAGONAL:
+                continue
+            op = out[i]
+            if all(top(q) == i for q in op[2]):
+                unemit(i)
+                hold(*op)
+                todo.extend(op[2])
+
+    for op in ops:
+        name, arg, qubits, dagger, cond = op
+        if name == "I" and cond is None:
+            continue
+        if name in DIAGONAL:
+            hold(*op)
+            continue
+        flush(qubits, arg if name == "MEASURE" else None)
+        if name in SELF_INVERSE and cond is None:
+            i = top(qubits[0])
+            if i is not None and same_gate(out[i], op) and all(top(q) == i for q in qubits):
+                unemit(i)
+                reabsorb(qubits)
+                continue
+        emit(op)
+    for key in list(pending):
+        op = phase_op(pending.pop(key), key[0], key[1])
+        if op is not None:
+            emit(op)
+    return [op for op in out if op is not None]
+
+def optimize(circuit):
+    # Returns the optimized Circuit and a Report of the op counts before and after
+    optimized = Circuit.from_ops(optimize_ops(circuit.ops()), circuit.num_qubits, circuit.num_bits)
+    return optimized, Report(circuit.counts(), optimized.counts())
+
+def format_report(report):
+    lines = ["{:>8} {:>10} {:>10} {:>8}".format("op", "before", "after", "removed")]
+    for name in sorted(set(report.before) | set(report.after)):
+        before = report.before.get(name, 0)
+        after = report.after.get(name, 0)
+        lines.append("{:>8} {:>10} {:>10} {:>8}".format(name, before, after, before - after))
+    before = sum(report.before.values())
+    after = sum(report.after.values())
+    lines.append("{:>8} {:>10} {:>10} {:>8}".format("total", before, after, before - after))
+    return "\n".join(lines)
+
+def main():
+    # python optimize.py N [a]
+    from period import period_circuit
+    N = int(sys.argv[1])
+    a = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+    _, report = optimize(period_circuit(a, N, N.bit_length()))
+    print(format_report(report))
+
+if __name__ == "__main__":
+    main()
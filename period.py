@@ -1,14 +1,22 @@
 import numpy as np
 
 import math
+import functools
+from collections import namedtuple
 
 from pyquil.quil import Program, address_qubits
-from pyquil.quilatom import QubitPlaceholder
+from pyquil.quilatom import QubitPlaceholder, LabelPlaceholder, unpack_qubit
 
-from pyquil.api import QVMConnection
-from pyquil.gates import X, I, H, CNOT, CCNOT, MEASURE, SWAP
+from pyquil.gates import X, I, H, CNOT, CCNOT, MEASURE, SWAP, PHASE, CPHASE
 from pyquil.parameters import Parameter, quil_exp
-from pyquil.quilbase import DefGate
+from pyquil.quilbase import DefGate, Gate, Jump, JumpWhen, JumpTarget
+
+from backends import get_backend
+from cache import CircuitCache
+from circuit import Circuit, CircuitBuilder, PHASE_BITS
+from optimize import optimize_ops
+from fuse import FUSION_QUBITS, fuse
+from metrics import count, recorder, span, timed
 
 def egcd(a, b):
     if a == 0:
@@ -24,8 +32,6 @@ def modinv(a, m):
     else:
         return x % m
 
-qvm = QVMConnection()
-
 k = Parameter('k')
 ccrk = np.array([
     [1, 0, 0, 0, 0, 0, 0, 0],
@@ -71,170 +77,472 @@ def REVERSE(p):
         rev_p += inst.dagger()
     return rev_p
 
+# The *_gates builders below are generators: they yield their gates one at a
+# time as (name, arg, qubits, dagger, cond) tuples, so a whole circuit can be
+# appended into a single buffer without building (and copying) an intermediate
+# Program per block. circuit.CircuitBuilder packs them into arrays, and
+# quil_gates turns them into pyQuil instructions. The upper case functions wrap
+# them for callers that want a Program.
+
+QUIL_GATES = {"I": I, "H": H, "X": X, "CNOT": CNOT, "CCNOT": CCNOT, "SWAP": SWAP}
+PARAMETRIC_GATES = {"RK": RK, "CRK": CRK, "CCRK": CCRK}
+
+def quil_gates(gates, ro=None):
+    # ro is the MemoryReference that MEASURE and conditional ops index into
+    for name, arg, qubits, dagger, cond in gates:
+        if name == "MEASURE":
+            yield MEASURE(qubits[0], ro[arg])
+            continue
+        if name in PARAMETRIC_GATES:
+            gate = PARAMETRIC_GATES[name](arg)(*qubits)
+        elif name == "FUSED":
+            # Defined by fused_program
+            gate = Gate("FUSED{}".format(arg), [], [unpack_qubit(q) for q in qubits])
+        elif name in ("PHASE", "CPHASE", "CCPHASE"):
+            angle = 2*np.pi * arg / 2**PHASE_BITS
+            if name == "PHASE":
+                gate = PHASE(angle, *qubits)
+            else:
+                gate = CPHASE(angle, *qubits[-2:])
+                if name == "CCPHASE":
+                    gate = gate.controlled(qubits[0])
+        else:
+            gate = QUIL_GATES[name](*qubits)
+        if dagger:
+            gate = gate.dagger()
+        if cond is None:
+            yield gate
+        else:
+            yield from if_then_gates(ro[cond], gate, I(qubits[-1]))
+
+def if_then_gates(classical_reg, if_gate, else_gate):
+    # The same instructions Program.if_then emits
+    label_then = LabelPlaceholder("THEN")
+    label_end = LabelPlaceholder("END")
+    yield JumpWhen(target=label_then, condition=classical_reg)
+    yield else_gate
+    yield Jump(label_end)
+    yield JumpTarget(label_then)
+    yield if_gate
+    yield JumpTarget(label_end)
+
+def reverse_gates(gates):
+    # Only the block being reversed is held in memory
+    for name, arg, qubits, dagger, cond in reversed(list(gates)):
+        yield (name, arg, qubits, not dagger, cond)
+
+def cswap_gates(c, l, r):
+    yield ("CNOT", 0, (r, l), False, None)
+    yield ("CCNOT", 0, (c, l, r), False, None)
+    yield ("CNOT", 0, (r, l), False, None)
+
 def CSWAP(c, l, r):
-    p = Program()
-    p += CNOT(r, l)
-    p += CCNOT(c, l, r)
-    p += CNOT(r, l)
-    return p
+    return Program(quil_gates(cswap_gates(c, l, r)))
 
-def QFT(reg):
-    p = Program()
+# k_max, where given, is the approximation cutoff: rotations of 2*pi/2**k with
+# k > k_max are dropped, which takes the QFT and adders from O(n**2) down to
+# O(n*k_max) gates. See fidelity.py for what each cutoff costs.
+
+def qft_gates(reg, k_max=None):
     n = len(reg)
     for i in range(n-1, -1, -1):
-        p += H(reg[i])
+        yield ("H", 0, (reg[i],), False, None)
         for j in range(i-1, -1, -1):
             k = i-j+1
-            p += CRK(k)(reg[j], reg[i])
+            if k_max is not None and k > k_max:
+                break
+            yield ("CRK", k, (reg[j], reg[i]), False, None)
 
-    return p
+def QFT(reg, k_max=None):
+    return Program(quil_gates(qft_gates(reg, k_max)))
 
-def PSIADDER(b, a):
-    # this is an adder in the fourier space
+def psiadder_gates(controls, b, a, k_max=None):
+    # this is an adder in the fourier space, controlled on 0, 1 or 2 qubits
     # b is a register of size n+1 with value fit in n bits
     # a is a classicall number, must also fit in n bits
     assert(a < 2**(len(b)-1))
-    p = Program()
+    gate = ("RK", "CRK", "CCRK")[len(controls)]
     n = len(b)
-    control = str(bin(a))[2:]
-    control = list(reversed("0"*(len(b)-len(control)) + control))
     for i in range(n-1, -1, -1):
         #TODO: we can condense these j gates
         for j in range(i, -1, -1):
-            if control[j] == "1":
-                k = i-j+1
-                p += RK(k)(b[i])
-    return p
+            k = i-j+1
+            if k_max is not None and k > k_max:
+                break
+            if (a >> j) & 1:
+                yield (gate, k, controls + (b[i],), False, None)
 
-def CPSIADDER(c1, b, a):
-    # this is an adder in the fourier space
-    # b is a register of size n+1 with value fit in n bits
-    # a is a classicall number, must also fit in n bits
-    assert(a < 2**(len(b)-1))
-    p = Program()
-    n = len(b)
-    control = str(bin(a))[2:]
-    control = list(reversed("0"*(len(b)-len(control)) + control))
-    for i in range(n-1, -1, -1):
-        #TODO: we can condense these j gates
-        for j in range(i, -1, -1):
-            if control[j] == "1":
-                k = i-j+1
-                p += CRK(k)(c1, b[i])
-    return p
+def PSIADDER(b, a, k_max=None):
+    return Program(quil_gates(psiadder_gates((), b, a, k_max)))
 
-def CCPSIADDER(c1, c2, b, a):
-    # this is an adder in the fourier space
-    # b is a register of size n+1 with value fit in n bits
-    # a is a classicall number, must also fit in n bits
-    assert(a < 2**(len(b)-1))
-    p = Program()
-    n = len(b)
-    control = str(bin(a))[2:]
-    control = list(reversed("0"*(len(b)-len(control)) + control))
-    for i in range(n-1, -1, -1):
-        #TODO: we can condense these j gates
-        for j in range(i, -1, -1):
-            if control[j] == "1":
-                k = i-j+1
-                p += CCRK(k)(c1, c2, b[i])
-    return p
+def CPSIADDER(c1, b, a, k_max=None):
+    return Program(quil_gates(psiadder_gates((c1,), b, a, k_max)))
 
+def CCPSIADDER(c1, c2, b, a, k_max=None):
+    return Program(quil_gates(psiadder_gates((c1, c2), b, a, k_max)))
 
-def PSIADDERMOD(c1, c2, b, a, N, zero):
-    p = Program()
+
+def psiaddermod_gates(c1, c2, b, a, N, zero, k_max=None):
     # make b = b+a
-    p += CCPSIADDER(c1, c2, b, a)
+    yield from psiadder_gates((c1, c2), b, a, k_max)
     # make b = b+a-N
-    p += REVERSE(PSIADDER(b, N))
+    yield from reverse_gates(psiadder_gates((), b, N, k_max))
 
     # make zero now has ?(b+a < N)
-    p += REVERSE(QFT(b))
-    p += CNOT(b[-1] , zero)
-    p += QFT(b)
+    yield from reverse_gates(qft_gates(b, k_max))
+    yield ("CNOT", 0, (b[-1] , zero), False, None)
+    yield from qft_gates(b, k_max)
 
     # if ?(b+a < N), add back N
-    p += CPSIADDER(zero, b, N)
+    yield from psiadder_gates((zero,), b, N, k_max)
     # now b = b+a Mod N
 
     # Must get zero back to 0
-    p += REVERSE(CCPSIADDER(c1, c2, b, a))
-    p += REVERSE(QFT(b))
-    p += X(b[-1])
-    p += CNOT(b[-1] , zero)
-    p += X(b[-1])
-    p += QFT(b)
-    p += CCPSIADDER(c1, c2, b, a)
-
-    return p
-
-def CMULTMOD(c1, x, b, a, N, zero):
+    yield from reverse_gates(psiadder_gates((c1, c2), b, a, k_max))
+    yield from reverse_gates(qft_gates(b, k_max))
+    yield ("X", 0, (b[-1],), False, None)
+    yield ("CNOT", 0, (b[-1] , zero), False, None)
+    yield ("X", 0, (b[-1],), False, None)
+    yield from qft_gates(b, k_max)
+    yield from psiadder_gates((c1, c2), b, a, k_max)
+
+def PSIADDERMOD(c1, c2, b, a, N, zero, k_max=None):
+    return Program(quil_gates(psiaddermod_gates(c1, c2, b, a, N, zero, k_max)))
+
+def cmultmod_gates(c1, x, b, a, N, zero, k_max=None):
     # takes in some x, b, outputs x, b + x*a mod N
-    p = Program()
-    p += QFT(b)
+    yield from qft_gates(b, k_max)
     for i in range(len(x)):
-        p += PSIADDERMOD(c1, x[i], b, (a*(2**i))%N, N, zero)
-    p += REVERSE(QFT(b))
-    return p
+        yield from psiaddermod_gates(c1, x[i], b, (a*(2**i))%N, N, zero, k_max)
+    yield from reverse_gates(qft_gates(b, k_max))
 
-def UA(c1, x, b, a, N, zero):
-    p = Program()
-    p += CMULTMOD(c1, x, b, a, N, zero)
-    for i in range(len(x)):
-        p += CSWAP(c1, x[i], b[i])
+def CMULTMOD(c1, x, b, a, N, zero, k_max=None):
+    return Program(quil_gates(cmultmod_gates(c1, x, b, a, N, zero, k_max)))
+
+def ua_inverse(a, N):
     ainv = modinv(a, N)
-    ainv = ainv+abs(math.floor(ainv/N))*N
-    p += REVERSE(CMULTMOD(c1, x, b, ainv, N, zero))
-    return p
+    return ainv+abs(math.floor(ainv/N))*N
 
-def period_helper(a, N, size):
-    c1 = QubitPlaceholder()
-    zero = QubitPlaceholder()
-    x = QubitPlaceholder.register(size)
-    b = QubitPlaceholder.register(size+1)
+def ua_gates(c1, x, b, a, N, zero, k_max=None):
+    yield from cmultmod_gates(c1, x, b, a, N, zero, k_max)
+    for i in range(len(x)):
+        yield from cswap_gates(c1, x[i], b[i])
+    yield from reverse_gates(cmultmod_gates(c1, x, b, ua_inverse(a, N), N, zero, k_max))
+
+def UA(c1, x, b, a, N, zero, k_max=None):
+    return Program(quil_gates(ua_gates(c1, x, b, a, N, zero, k_max)))
+
+def measure_round_gates(c1, i, k_max=None):
+    # the inverse QFT's rotations, applied classically
+    for j in range(i):
+        k = i-j+1
+        if k_max is None or k <= k_max:
+            yield ("RK", k, (c1,), True, j)
+    yield ("H", 0, (c1,), False, None)
+    yield ("MEASURE", i, (c1,), False, None)
+    yield ("X", 0, (c1,), False, i)
+
+def period_gates(c1, x, b, a, N, zero, n, k_max=None):
+    # MEASURE and the classically conditioned corrections refer to ro by index
+    #For one reg, we want H, CUA, R_i m_i, X^m_i
+    for i in range(n):
+        yield ("H", 0, (c1,), False, None)
+        # a**(2**i) is only ever used mod N, so never build the full power
+        yield from ua_gates(c1, x, b, pow(a, 2**i, N), N, zero, k_max)
+        yield from measure_round_gates(c1, i, k_max)
+
+####################################################################################################
+#
+#                                         Gate templates
+#
+####################################################################################################
+
+# Every PSIADDERMOD on an m qubit b register has the same gates, except for
+# which adder rotations the bits of a and N switch on. A Template holds the
+# block once, as a Circuit on slot qubits with every rotation present, and
+# stamps out copies by masking rotations on the bits of the constants and
+# relabelling the slots. Building circuits from templates never goes through
+# the generators above, apart from building each template once.
+
+ALWAYS = 0
+
+class Template(object):
+    """A Circuit on slot qubits whose rotations can be masked by constants
+
+    source[row] is ALWAYS, or 1 + the index of the constant whose bit
+    number bit[row] decides whether the row is kept.
+    """
+
+    def __init__(self, circuit, source, bit, width):
+        self.circuit = circuit
+        self.source = source
+        self.bit = bit
+        self.width = width
+        self._reversed = None
+
+    def reversed(self):
+        if self._reversed is None:
+            self._reversed = Template(self.circuit.reversed(), self.source[::-1],
+                                      self.bit[::-1], self.width)
+            self._reversed._reversed = self
+        return self._reversed
+
+    def stamp(self, mapping, constants=(), num_qubits=None):
+        # A Circuit of the block for these constants, with slot q on mapping[q]
+        keep = self.source == ALWAYS
+        for i, value in enumerate(constants):
+            bits = np.array([(value >> j) & 1 for j in range(self.width)], dtype=np.bool_)
+            keep |= (self.source == i+1) & bits[self.bit]
+        return self.circuit.take(keep).relabel(mapping, num_qubits)
+
+def fixed_template(ops, num_slots):
+    circuit = CircuitBuilder().extend(ops).build(num_slots)
+    zeros = np.zeros(len(circuit), dtype=np.int32)
+    return Template(circuit, zeros, zeros, 0)
+
+@functools.lru_cache(maxsize=None)
+def qft_template(m, k_max=None):
+    return fixed_template(qft_gates(list(range(m)), k_max), m)
+
+@functools.lru_cache(maxsize=None)
+def cswap_template():
+    return fixed_template(cswap_gates(0, 1, 2), 3)
+
+@functools.lru_cache(maxsize=None)
+def psiaddermod_template(m, k_max=None):
+    # Slots are b on 0..m-1, then c1, c2 and zero. Built with every allowed
+    # bit of a and N set; the CCRKs add a, the RKs and the zero controlled
+    # CRKs add N, and the rest is the QFTs and comparison.
+    b = list(range(m))
+    c1, c2, zero = m, m+1, m+2
+    ones = 2**(m-1) - 1
+    ops = list(psiaddermod_gates(c1, c2, b, ones, ones, zero, k_max))
+    circuit = CircuitBuilder().extend(ops).build(m+3)
+    source = np.zeros(len(ops), dtype=np.int32)
+    bit = np.zeros(len(ops), dtype=np.int32)
+    for row, (name, k, qubits, _, _) in enumerate(ops):
+        if name == "CCRK":
+            source[row] = 1
+        elif name == "RK" or (name == "CRK" and qubits[0] == zero):
+            source[row] = 2
+        else:
+            continue
+        # The rotation by 2*pi/2**k onto b[i] comes from bit i-k+1
+        bit[row] = qubits[-1] - k + 1
+    return Template(circuit, source, bit, m)
+
+# Stamps are (template, mapping, constants) triples, so whole blocks can be
+# reversed before anything is built
+
+def cmultmod_stamps(c1, x, b, a, N, zero, k_max=None):
+    qft = qft_template(len(b), k_max)
+    adder = psiaddermod_template(len(b), k_max)
+    stamps = [(qft, b, ())]
+    for i in range(len(x)):
+        stamps.append((adder, b + [c1, x[i], zero], ((a*(2**i))%N, N)))
+    stamps.append((qft.reversed(), b, ()))
+    return stamps
+
+def reverse_stamps(stamps):
+    return [(template.reversed(), mapping, constants)
+            for template, mapping, constants in reversed(stamps)]
+
+def ua_stamps(c1, x, b, a, N, zero, k_max=None):
+    stamps = cmultmod_stamps(c1, x, b, a, N, zero, k_max)
+    for i in range(len(x)):
+        stamps.append((cswap_template(), [c1, x[i], b[i]], ()))
+    stamps += reverse_stamps(cmultmod_stamps(c1, x, b, ua_inverse(a, N), N, zero, k_max))
+    return stamps
+
+def stamp_all(stamps, num_qubits):
+    return [template.stamp(mapping, constants, num_qubits)
+            for template, mapping, constants in stamps]
+
+# Where the registers of the period finding circuits live. The layout is
+# fixed by size, so gates are emitted on their final qubit indices and the
+# program never needs an address_qubits pass. placeholders=True hands out
+# QubitPlaceholders instead, for composing with other programs before
+# addressing them.
+Layout = namedtuple("Layout", ["c1", "zero", "x", "b"])
+SlowLayout = namedtuple("SlowLayout", ["inp", "zero", "x", "b"])
+
+def period_layout(size, placeholders=False):
+    # c1, zero, x and b on qubits 0, 1, 2..size+1 and size+2..2*size+2
+    if placeholders:
+        return Layout(QubitPlaceholder(), QubitPlaceholder(),
+                      QubitPlaceholder.register(size), QubitPlaceholder.register(size+1))
+    return Layout(0, 1, list(range(2, size+2)), list(range(size+2, 2*size+3)))
+
+def period_slow_layout(size, placeholders=False):
+    # inp, zero, x and b on qubits 0..2*size-1, 2*size, 2*size+1..3*size
+    # and 3*size+1..4*size+1
+    if placeholders:
+        return SlowLayout(QubitPlaceholder.register(2*size), QubitPlaceholder(),
+                          QubitPlaceholder.register(size), QubitPlaceholder.register(size+1))
+    return SlowLayout(list(range(2*size)), 2*size, list(range(2*size+1, 3*size+1)),
+                      list(range(3*size+1, 4*size+2)))
+
+@timed("period_helper")
+def period_helper(a, N, size, k_max=None, placeholders=False):
+    # With placeholders, the caller is left to address the program
+    layout = period_layout(size, placeholders)
     #takes in x and b as zero, finds
-    p = Program()
+    p = get_defs()
 
     n = 2*size
-    def_regs = Program()
-    period_regs = def_regs.declare('ro', 'BIT', n)
-
-    #For one reg, we want H, CUA, R_i m_i, X^m_i
-    for i in range(n-1, -1, -1):
-        R = Program()
-        R += H(c1)
-        for j in range(i-1, -1, -1):
-            k = i-j+1
-            doit = Program()
-            doit += RK(k)(c1).dagger()
-            R = Program().if_then(period_regs[j], doit, I(c1)) + R
-        R += MEASURE(c1, period_regs[i])
-        R += Program().if_then(period_regs[i], X(c1), I(c1))
-        #R = Program(H(c1)) + R
-        R = Program(H(c1)) + UA(c1, x, b, a**(2**i), N, zero) + R
-        p = R + p
-    p = write_in(1, x) + p
-    p = def_regs + p
-    p = get_defs() + p
-    p = address_qubits(p)
+    period_regs = p.declare('ro', 'BIT', n)
+    p += write_in(1, layout.x)
+    p.inst(quil_gates(period_gates(layout.c1, layout.x, layout.b, a, N, layout.zero, n, k_max), period_regs))
+    # Counting reads p.instructions, which makes pyQuil synthesize the program
+    if recorder() is not None:
+        count("gates", len(p.instructions))
     return p
 
-def PERIOD(a, N, size):
-    p = period_helper(a, N, size)
-    result = qvm.run(p)
-    outp = 0
-    for i in range(len(result[0])):
-        if(list(reversed(result[0]))[i] == 1):
-            outp += 2**i
+@timed("period_circuit")
+def period_circuit(a, N, size, optimized=False, k_max=None):
+    # period_helper as a compact Circuit. optimized runs the op stream
+    # through the peephole pass in optimize.py on its way in.
+    # The UA blocks are stamped from templates, so only the first circuit of
+    # a given size pays for generating their gates.
+    layout = period_layout(size)
+    n = 2*size
+    num_qubits = 2*size+3
+    parts = [CircuitBuilder().extend(write_in_gates(1, layout.x)).build(num_qubits)]
+    for i in range(n):
+        parts.append(CircuitBuilder().extend([("H", 0, (layout.c1,), False, None)]).build(num_qubits))
+        parts += stamp_all(ua_stamps(layout.c1, layout.x, layout.b, pow(a, 2**i, N), N, layout.zero, k_max), num_qubits)
+        parts.append(CircuitBuilder().extend(measure_round_gates(layout.c1, i, k_max)).build(num_qubits))
+    circuit = Circuit.concatenate(parts, num_qubits, n)
+    if optimized:
+        circuit = CircuitBuilder().extend(optimize_ops(circuit.ops())).build(num_qubits, n)
+    count("gates", len(circuit))
+    return circuit
+
+def round_ends(size, i, measured, k_max=None):
+    # The gates of round i of period_circuit either side of its UA, as two
+    # Circuits, for a sequential backend. The earlier outcomes are known, so
+    # the reset of c1 and the inverse QFT's rotations are applied
+    # unconditionally where measured calls for them. The outcome goes to
+    # the second circuit's only bit.
+    layout = period_layout(size)
+    num_qubits = 2*size+3
+    if i == 0:
+        head = list(write_in_gates(1, layout.x))
+    else:
+        head = [("X", 0, (layout.c1,), False, None)] if measured[-1] else []
+    head.append(("H", 0, (layout.c1,), False, None))
+    tail = []
+    for j in range(i):
+        k = i-j+1
+        if measured[j] and (k_max is None or k <= k_max):
+            tail.append(("RK", k, (layout.c1,), True, None))
+    tail += [("H", 0, (layout.c1,), False, None), ("MEASURE", 0, (layout.c1,), False, None)]
+    return (CircuitBuilder().extend(head).build(num_qubits),
+            CircuitBuilder().extend(tail).build(num_qubits, 1))
+
+def round_ua(a, N, size, i, optimized=False, k_max=None):
+    # The UA of round i, which doesn't depend on the earlier outcomes, so
+    # a sequential run can build it once and reuse it for every shot
+    layout = period_layout(size)
+    num_qubits = 2*size+3
+    parts = stamp_all(ua_stamps(layout.c1, layout.x, layout.b, pow(a, 2**i, N), N, layout.zero, k_max),
+                      num_qubits)
+    circuit = Circuit.concatenate(parts, num_qubits, 0)
+    if optimized:
+        circuit = CircuitBuilder().extend(optimize_ops(circuit.ops())).build(num_qubits)
+    count("gates", len(circuit))
+    return circuit
+
+def sequential_period(a, N, size, backend, shots=1, optimized=True, k_max=None, fusion=FUSION_QUBITS):
+    # PERIOD on a backend with sessions, streaming each measured bit back
+    # before the next round's ends are built. Each round's UA is built,
+    # fused and compiled on first use and kept for the later shots.
+    n = 2*size
+    outp = np.zeros(shots, dtype=np.int64)
+    rounds = []
+    for shot in range(shots):
+        session = backend.session(2*size+3)
+        measured = []
+        for i in range(n):
+            if i == len(rounds):
+                circuit, blocks = round_ua(a, N, size, i, optimized, k_max), 0
+                if fusion:
+                    circuit, report = fuse(circuit, fusion)
+                    blocks = report.blocks
+                rounds.append((session.compile(circuit), blocks))
+            circuit, blocks = rounds[i]
+            count("fused_blocks", blocks)
+            head, tail = round_ends(size, i, measured, k_max)
+            with span("session.run", backend=backend.name, round=i):
+                session.run(head)
+                session.run(circuit)
+                measured += session.run(tail)
+        # The first bit measured is the most significant
+        for bit in measured:
+            outp[shot] = 2*outp[shot] + bit
     return outp
 
-def PERIOD_slow(a, N, size):
+def circuit_program(circuit):
+    # Expands a Circuit, or a FusedCircuit, back into an addressed pyQuil
+    # Program. Fused blocks become gates named FUSED<i>, defined up front.
+    p = get_defs()
+    for i, matrix in enumerate(getattr(circuit, "matrices", [])):
+        p += DefGate("FUSED{}".format(i), matrix)
+    ro = p.declare('ro', 'BIT', circuit.num_bits) if circuit.num_bits else None
+    p.inst(quil_gates(circuit.ops(), ro))
+    return p
+
+# Built period finding circuits, keyed by (a mod N, N, size, optimized, k_max). Set
+# circuit_cache.directory to also keep them on disk between runs.
+circuit_cache = CircuitCache()
+
+def cached_period_circuit(a, N, size, optimized=False, k_max=None):
+    # The circuit only depends on a through its residues mod N. Circuits are
+    # read only, so the cached one can be shared.
+    a = a % N
+    return circuit_cache.get((a, N, size, optimized, k_max),
+                             lambda: period_circuit(a, N, size, optimized, k_max))
+
+@functools.lru_cache(maxsize=16)
+def cached_fused_circuit(a, N, size, optimized=False, k_max=None, fusion=FUSION_QUBITS):
+    # cached_period_circuit with its gates fused into blocks on at most
+    # fusion qubits, see fuse.py, and the fuse Report. Takes a already
+    # reduced mod N, so equal circuits share an entry.
+    circuit = cached_period_circuit(a, N, size, optimized, k_max)
+    with span("fuse"):
+        return fuse(circuit, fusion)
+
+@timed("PERIOD")
+def PERIOD(a, N, size, backend=None, shots=1, optimized=True, k_max=None, fusion=FUSION_QUBITS):
+    # Returns the measured value of every shot as an array. fusion is the
+    # most qubits a fused block may act on, None runs the gates unfused.
+    backend = get_backend(backend)
+    a = a % N
+    count("shots", shots)
+    with span("backend.shortcut_period", backend=backend.name):
+        outp = backend.shortcut_period(a, N, size, shots)
+    if outp is not None:
+        return outp
+    if backend.sequential:
+        return sequential_period(a, N, size, backend, shots, optimized, k_max, fusion)
+    if fusion:
+        p, report = cached_fused_circuit(a, N, size, optimized, k_max, fusion)
+        count("fused_blocks", report.blocks)
+    else:
+        p = cached_period_circuit(a, N, size, optimized, k_max)
+    if not backend.runs_circuits:
+        with span("circuit_program"):
+            p = circuit_program(p)
+    with span("backend.run", backend=backend.name, shots=shots):
+        result = backend.run(p, shots)
+    # ro[0] holds the most significant bit
+    weights = 1 << np.arange(result.shape[1]-1, -1, -1, dtype=np.int64)
+    return result.astype(np.int64).dot(weights)
+
+def PERIOD_slow(a, N, size, backend=None, k_max=None):
     #NOTE: This code is accomplishes the same goal as PERIOD,
     #  but it does not use the single qubit input register trick.
-    inp = QubitPlaceholder.register(2*size)
-    zero = QubitPlaceholder()
-    x = QubitPlaceholder.register(size)
-    b = QubitPlaceholder.register(size+1)
+    inp, zero, x, b = period_slow_layout(size)
     #takes in x and b as zero, finds
     p = Program()
     p += get_defs()
@@ -242,34 +550,38 @@ def PERIOD_slow(a, N, size):
     for i in range(len(inp)):
         p += H(inp[i])
     for i in range(len(inp)):
-        p += UA(inp[i], x, b, (a**(2**i)), N, zero)
-    p += REVERSE(QFT(inp))
+        p.inst(quil_gates(ua_gates(inp[i], x, b, pow(a, 2**i, N), N, zero, k_max)))
+    p.inst(quil_gates(reverse_gates(qft_gates(inp, k_max))))
     print("Running a period finding alg using {} gates".format(len(p.instructions)))
-    outp, p = read_out(p, list(reversed(inp)))
+    outp, p = read_out(p, list(reversed(inp)), backend)
     return outp
 
 
-def write_in(val, reg):
-    p = Program()
-
+def write_in_gates(val, reg):
     bitstring = str(bin(val))[2:]
     bitstring = "0"*(len(reg)-len(bitstring)) + bitstring
 
     for idx, bit in enumerate(reversed(list(bitstring))):
         if bit == "1":
-            p += X(reg[idx])
+            yield ("X", 0, (reg[idx],), False, None)
 
-    return p
+def write_in(val, reg):
+    return Program(quil_gates(write_in_gates(val, reg)))
 
-def read_out(p, reg):
+def read_out(p, reg, backend=None):
 
     ro = p.declare('ro', 'BIT', len(reg))
 
     for i in range(len(reg)):
         p += MEASURE(reg[i], ro[i])
 
-    p = address_qubits(p)
-    result = qvm.run(p)
+    # Programs built on a concrete layout are already addressed
+    if any(isinstance(q, QubitPlaceholder) for q in reg):
+        with span("address_qubits"):
+            p = address_qubits(p)
+    backend = get_backend(backend)
+    with span("backend.run", backend=backend.name, shots=1):
+        result = backend.run(p)
 
     outp = 0
     for i in range(len(result[0])):
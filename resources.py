@@ -0,0 +1,147 @@
+"""resources.py: gate counts, depth and qubit counts of the period finding circuits
+
+Gate counts are closed form per block of the builders in period.py, so they
+stay cheap for N far too large to build. Depth needs the order of the gates
+and walks the builders' op stream instead, which is linear in the gate count
+but never creates pyQuil objects or a Circuit.
+"""
+
+import itertools
+from collections import Counter, namedtuple
+
+from period import (modinv, period_gates, ua_gates, qft_gates, reverse_gates,
+                    write_in_gates, period_layout, period_slow_layout)
+
+Estimate = namedtuple("Estimate", ["gates", "instructions", "depth", "qubits"])
+
+# k_max is the rotation cutoff of the approximate circuits, None for exact
+
+def adder_count(a, m, k_max=None):
+    # Rotations emitted by PSIADDER(b, a) and its controlled versions when b
+    # has m qubits: bit j of a contributes one gate to each of b[j..m-1], or
+    # to the first k_max of them
+    count = 0
+    j = 0
+    while a:
+        if a & 1:
+            count += m - j if k_max is None else min(m - j, k_max)
+        a >>= 1
+        j += 1
+    return count
+
+def rotation_count(m, k_max=None):
+    # CRK gates in a QFT on m qubits: m-d pairs at each distance d, which
+    # make rotations of k = d+1
+    if k_max is None or k_max >= m:
+        return m*(m-1)//2
+    return sum(m - d for d in range(1, k_max))
+
+def qft_counts(m, k_max=None):
+    return Counter({"H": m, "CRK": rotation_count(m, k_max)})
+
+def psiaddermod_counts(a, N, m, k_max=None):
+    c = Counter()
+    c["CCRK"] += 3*adder_count(a, m, k_max)
+    c["RK"] += adder_count(N, m, k_max)
+    c["CRK"] += adder_count(N, m, k_max)
+    for _ in range(4):
+        c += qft_counts(m, k_max)
+    c["CNOT"] += 2
+    c["X"] += 2
+    return c
+
+def cmultmod_counts(a, N, size, k_max=None):
+    c = qft_counts(size+1, k_max) + qft_counts(size+1, k_max)
+    for i in range(size):
+        c += psiaddermod_counts((a*(2**i)) % N, N, size+1, k_max)
+    return c
+
+def ua_counts(a, N, size, k_max=None):
+    c = cmultmod_counts(a, N, size, k_max)
+    c["CNOT"] += 2*size
+    c["CCNOT"] += size
+    c += cmultmod_counts(modinv(a, N), N, size, k_max)
+    return c
+
+def if_then_counts(gate):
+    # JUMP-WHEN, the I else branch, JUMP, two labels and the gate itself
+    return Counter({"JUMP-WHEN": 1, "I": 1, "JUMP": 1, "LABEL": 2, gate: 1})
+
+def period_helper_counts(a, N, size, k_max=None):
+    n = 2*size
+    # write_in(1, x) is a single X
+    c = Counter({"DECLARE": 1, "X": 1})
+    for i in range(n):
+        c["H"] += 2
+        c += ua_counts(pow(a, 2**i, N), N, size, k_max)
+        for _ in range(i if k_max is None else min(i, k_max-1)):
+            c += if_then_counts("RK")
+        c["MEASURE"] += 1
+        c += if_then_counts("X")
+    return c
+
+def period_slow_counts(a, N, size, k_max=None):
+    n = 2*size
+    c = Counter({"DECLARE": 1, "X": 1, "H": n})
+    for i in range(n):
+        c += ua_counts(pow(a, 2**i, N), N, size, k_max)
+    c += qft_counts(n, k_max)
+    c["MEASURE"] += n
+    return c
+
+CLASSICAL = ("DECLARE", "JUMP-WHEN", "JUMP", "LABEL")
+
+def _estimate(gates, qubits, stream):
+    depth = None
+    if stream is not None:
+        depth = circuit_depth(stream, qubits)
+    quantum = Counter({g: n for g, n in gates.items() if g not in CLASSICAL})
+    return Estimate(quantum, sum(gates.values()), depth, qubits)
+
+def estimate(a, N, size, depth=False, k_max=None):
+    # Resources of period_helper(a, N, size, k_max). instructions matches
+    # len(p.instructions), including the classical control flow.
+    stream = period_helper_stream(a, N, size, k_max) if depth else None
+    return _estimate(period_helper_counts(a, N, size, k_max), 2*size + 3, stream)
+
+def estimate_slow(a, N, size, depth=False, k_max=None):
+    # Resources of PERIOD_slow(a, N, size), including the final read out
+    stream = period_slow_stream(a, N, size, k_max) if depth else None
+    return _estimate(period_slow_counts(a, N, size, k_max), 4*size + 2, stream)
+
+####################################################################################################
+#
+#                                          Depth walking
+#
+####################################################################################################
+
+# The streams below are the qubit tuples of the op stream the builders in
+# period.py yield, without packing them into a Circuit, on the same layouts as
+# period_helper and PERIOD_slow. A conditional op counts as one layer on its
+# qubit, whichever branch runs.
+
+def circuit_depth(stream, num_qubits):
+    frontier = [0]*num_qubits
+    for qubits in stream:
+        layer = max(frontier[q] for q in qubits) + 1
+        for q in qubits:
+            frontier[q] = layer
+    return max(frontier) if frontier else 0
+
+def period_helper_stream(a, N, size, k_max=None):
+    c1, zero, x, b = period_layout(size)
+    ops = itertools.chain(write_in_gates(1, x), period_gates(c1, x, b, a, N, zero, 2*size, k_max))
+    return (qubits for _, _, qubits, _, _ in ops)
+
+def period_slow_stream(a, N, size, k_max=None):
+    inp, zero, x, b = period_slow_layout(size)
+    yield (x[0],)
+    for q in inp:
+        yield (q,)
+    for i, q in enumerate(inp):
+        for _, _, qubits, _, _ in ua_gates(q, x, b, pow(a, 2**i, N), N, zero, k_max):
+            yield qubits
+    for _, _, qubits, _, _ in reverse_gates(qft_gates(inp, k_max)):
+        yield qubits
+    for q in reversed(inp):
+        yield (q,)
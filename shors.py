@@ -5,12 +5,19 @@
 import math
 import random
 import argparse
+import multiprocessing
+import sys
+from contextlib import nullcontext
 from pyquil.quil import Program
 from pyquil.api import QVMConnection
 from pyquil.gates import X, I
 import numpy as np
 
-from period import PERIOD
+from period import PERIOD, circuit_cache
+from numbertheory import gcd, modExp, isProbablePrime, pollardRho
+from backends import BACKENDS, DEFAULT_BACKEND, SimulatorBackend, backend_class, configure, reseed_all
+import metrics
+from metrics import count, timed
 
 __author__ = "Todd Wildey"
 __copyright__ = "Copyright 2013"
@@ -37,20 +44,20 @@ printInfo = printNone
 ####################################################################################################
 
 
-def findPeriod(a, N):
+@timed("findPeriod")
+def findPeriod(a, N, backend = None, shots = 1, kMax = None):
     nNumBits = N.bit_length()
-    inputNumBits = (2 * nNumBits) - 1
-    inputNumBits += 1 if ((1 << inputNumBits) < (N * N)) else 0
-    Q = 1 << inputNumBits
+    # PERIOD measures 2 * nNumBits bits
+    Q = 1 << (2 * nNumBits)
 
     printInfo("Finding the period...")
     printInfo("Q = " + str(Q) + "\ta = " + str(a))
 
     printInfo("Using {} bits".format(nNumBits))
-    mine = PERIOD(a, N, nNumBits)
-    printInfo("The x I found \tx = {:8b}".format(mine))
-    r2 = cf(mine, Q, N)
-    printInfo("My period\tr = {}".format(r2))
+    mine = PERIOD(a, N, nNumBits, backend, shots, k_max = kMax)
+    printInfo("The x I found \tx = " + ", ".join("{:8b}".format(x) for x in mine))
+    r2 = cfBatch(mine, Q, N)
+    printInfo("My period\tr = " + ", ".join(str(r) for r in r2))
     return r2
 
 ####################################################################################################
@@ -69,149 +76,337 @@ def bitCount(x):
 
     return sumBits
 
-# Greatest Common Divisor
-def gcd(a, b):
-    while b != 0:
-        tA = a % b
-        a = b
-        b = tA
-
+def pick(N):
+    a = math.floor((random.random() * (N - 1)) + 0.5)
     return a
 
-# Extended Euclidean
-def extendedGCD(a, b):
-    fractions = []
-    while b != 0:
-        fractions.append(a // b)
-        tA = a % b
-        a = b
-        b = tA
+####################################################################################################
+#                                                                                                   
+#                                   Batched Classical Components                                    
+#                                                                                                   
+####################################################################################################
 
-    return fractions
+def intArray(values, bound):
+    # int64 while every intermediate below bound fits, Python ints past that
+    dtype = np.int64 if bound < (1 << 62) else object
+    return np.array([int(v) for v in values], dtype=dtype)
+
+# Continued fractions over a whole batch of measurements, stepping all of the
+# Euclidean expansions together. Each element gets the last convergent's
+# denominator below N, stopping early if two convergents share one.
+@timed("cfBatch")
+def cfBatch(ys, Q, N):
+    ys = intArray(ys, Q * N)
+    zero = np.zeros_like(ys)
+
+    # Skip the leading quotient, ys < Q makes it 0 with denominator 1
+    a = zero + Q
+    b = ys % Q
+    qPrev = zero
+    q = zero + 1
+    r = zero.copy()
+    active = b != 0
+
+    while active.any():
+        safeB = np.where(active, b, 1)
+        qNew = (a // safeB) * q + qPrev
+        active &= qNew < N
+        r = np.where(active, qNew, r)
+        qPrev, q = np.where(active, q, qPrev), np.where(active, qNew, q)
+        a, b = np.where(active, b, a), np.where(active, a % safeB, b)
+        active &= b != 0
 
-# Continued Fractions
-def cf(y, Q, N):
-    fractions = extendedGCD(y, Q)
-    depth = 2
+    return r
 
-    def partial(fractions, depth):
-        c = 0
-        r = 1
+# Modular exponentiation of one base to a batch of exponents. Exponents below
+# one give 1, like modExp.
+def modExpBatch(a, exps, mod):
+    exps = np.maximum(intArray(exps, mod * mod), 0)
+    fx = np.ones_like(exps)
+    a = a % mod
+    while (exps > 0).any():
+        fx = np.where((exps & 1) == 1, (fx * a) % mod, fx)
+        a = (a * a) % mod
+        exps = exps >> 1
 
-        for i in reversed(range(depth)):
-            tR = fractions[i] * r + c
-            c = r
-            r = tR
+    return fx
 
-        return c
+# Most exponents checkCandidatesBatch raises at once
+CHECK_CHUNK = 1 << 16
+
+# The candidate periods tried for each r, at the given positions in the
+# order they're tried: the multiples k*r for k up to neighborhood+1, then
+# the lower and upper neighborhoods of r
+def candidateColumns(rs, columns, neighborhood):
+    multiple = columns < neighborhood + 1
+    offsets = np.where(columns < 2 * neighborhood + 1, columns - 2 * neighborhood - 1, columns - 2 * neighborhood)
+    return np.where(multiple, rs[:, None] * (columns + 1), rs[:, None] + offsets)
+
+# Verifies a batch of candidate periods, trying each candidate's multiples
+# and neighbors in turn for the first tR with a**(a+tR) == a**a mod N. Each
+# distinct candidate is checked once, a chunk of its candidate periods at a
+# time. The first chunk is just the candidate itself, later ones double in
+# width while staying under CHECK_CHUNK exponents, and only candidates
+# nothing has verified yet go on to the next. Returns the verified period
+# for each input, or -1 where none of its neighbors check out.
+@timed("checkCandidatesBatch")
+def checkCandidatesBatch(a, rs, N, neighborhood):
+    rs = intArray(rs, N * N)
+    if len(rs) == 0:
+        return rs
+
+    unique, inverse = np.unique(rs, return_inverse=True)
+    verified = np.full(len(unique), -1, dtype=unique.dtype)
+    target = modExp(a, a, N)
+
+    active = np.arange(len(unique))
+    total = 3 * neighborhood + 1
+    start = 0
+    width = 1
+    while len(active) > 0 and start < total:
+        columns = np.arange(start, min(start + width, total))
+        tR = candidateColumns(unique[active], columns, neighborhood)
+        exps, where = np.unique(tR, return_inverse=True)
+        matches = (modExpBatch(a, a + exps, N) == target)[where.reshape(tR.shape)]
+
+        found = matches.any(axis=1)
+        first = np.argmax(matches, axis=1)
+        verified[active[found]] = tR[found, first[found]]
+        active = active[~found]
+        start += len(columns)
+        width = max(1, min(2 * width, CHECK_CHUNK // max(len(active), 1)))
+
+    return verified[inverse]
+
+# Drops candidates that weren't verified, are odd, or are trivial
+def usablePeriods(a, rs, N):
+    rs = rs[(rs > 0) & (rs % 2 == 0)]
+    return rs[modExpBatch(a, rs // 2, N) != N - 1]
 
-    r = 0
-    for d in range(depth, len(fractions) + 1):
-        tR = partial(fractions, d)
-        if tR == r or tR >= N:
-            return r
+####################################################################################################
+#                                                                                                   
+#                                      Classical Pre-screening                                      
+#                                                                                                   
+####################################################################################################
 
-        r = tR
+# Shor's algorithm needs an odd N that isn't a prime or a prime power, and a
+# lot of inputs have a factor small enough to just find. These checks run
+# before any circuit is built.
 
-    return r
+def trialDivision(N, bound):
+    # Smallest factor of N up to bound, or None
+    for d in range(2, min(bound, N - 1) + 1):
+        if N % d == 0:
+            return d
+        if d * d > N:
+            break
 
-# Modular Exponentiation
-def modExp(a, exp, mod):
-    fx = 1
-    while exp > 0:
-        if (exp & 1) == 1:
-            fx = fx * a % mod
-        a = (a * a) % mod
-        exp = exp >> 1
+    return None
 
-    return fx
+# Largest x with x ** k <= N
+def integerRoot(N, k):
+    x = 1 << ((N.bit_length() + k - 1) // k)
+    while True:
+        y = ((k - 1) * x + N // x ** (k - 1)) // k
+        if y >= x:
+            return x
+        x = y
+
+# Returns b with b ** k == N for some k > 1, or None
+def perfectPower(N):
+    for k in range(2, N.bit_length() + 1):
+        b = integerRoot(N, k)
+        if b < 2:
+            break
+        if b ** k == N:
+            return b
 
-def pick(N):
-    a = math.floor((random.random() * (N - 1)) + 0.5)
-    return a
+    return None
 
-def checkCandidates(a, r, N, neighborhood):
-    if r is None:
-        return None
+# Factors of a composite N found without any quantum work, or None.
+# Evenness and perfect powers are always checked, trial division and
+# Pollard's rho only up to trialBound and rhoBudget.
+@timed("preScreen")
+def preScreen(N, trialBound = 0, rhoBudget = 0):
+    if N > 2 and N % 2 == 0:
+        return [2, N // 2]
 
-    # Check multiples
-    for k in range(1, neighborhood + 2):
-        tR = k * r
-        if modExp(a, a, N) == modExp(a, a + tR, N):
-            return tR
+    d = trialDivision(N, trialBound)
+    if d is not None:
+        return [d, N // d]
 
-    # Check lower neighborhood
-    for tR in range(r - neighborhood, r):
-        if modExp(a, a, N) == modExp(a, a + tR, N):
-            return tR
+    b = perfectPower(N)
+    if b is not None:
+        return [b, N // b]
 
-    # Check upper neigborhood
-    for tR in range(r + 1, r + neighborhood + 1):
-        if modExp(a, a, N) == modExp(a, a + tR, N):
-            return tR
+    d = pollardRho(N, rhoBudget)
+    if d is not None:
+        return [d, N // d]
 
     return None
 
-def shors(N, attempts = 1, neighborhood = 0.0, numPeriods = 1):
-    if(N.bit_length() > BIT_LIMIT or N < 3):
-        return False
+# Checks N for primality and runs preScreen, returning whether shors can
+# stop and what it should return, [N] for a prime N
+def classicalShortcut(N, trialBound, rhoBudget):
+    if isProbablePrime(N):
+        printInfo("N is prime")
+        return True, [N]
+    factors = preScreen(N, trialBound, rhoBudget)
+    if factors is not None:
+        printInfo("Found factors classically")
+        return True, factors
+    return False, None
+
+def pickCoprime(N):
+    # Returns a base for an attempt, or None if it shares a factor with N
+    a = pick(N)
+    while a < 2:
+        a = pick(N)
+
+    d = gcd(a, N)
+    if d > 1:
+        printInfo("Found factors classically, re-attempt")
+        return None
 
-    periods = []
-    neighborhood = math.floor(N * neighborhood) + 1
+    return a
+
+# Everything one attempt does with its base a, returning the usable periods
+def attemptPeriods(a, N, neighborhood, backend = None, shots = 1, kMax = None):
+    # One circuit build and one backend call give a candidate per shot
+    r = findPeriod(a, N, backend, shots, kMax)
+
+    printInfo("Checking candidate periods, nearby values, and multiples")
 
+    found = usablePeriods(a, checkCandidatesBatch(a, r, N, neighborhood), N)
+    printInfo("{} of {} candidates gave a usable period".format(len(found), len(r)))
+
+    if len(found) == 0:
+        printInfo("Period was not found, re-attempt")
+
+    return [int(r) for r in found]
+
+def factorsFromPeriods(a, periods, N):
+    printInfo("\nFinding least common multiple of all periods")
+
+    r = 1
+    for period in periods:
+        d = gcd(period, r)
+        r = (r * period) // d
+
+    b = modExp(a, (r // 2), N)
+    f1 = gcd(N, b + 1)
+    f2 = gcd(N, b - 1)
+
+    return [f1, f2]
+
+def printSettings(N, neighborhood, numPeriods, shots):
     printInfo("N = " + str(N))
     printInfo("Neighborhood = " + str(neighborhood))
     printInfo("Number of periods = " + str(numPeriods))
+    printInfo("Shots per attempt = " + str(shots))
 
-    for attempt in range(attempts):
-        printInfo("\nAttempt #" + str(attempt))
+# The checks and settings shors and shorsParallel share, run before any
+# attempt. Returns whether shors can stop, what it should return, and the
+# neighborhood as a count of values rather than a fraction of N.
+def prepare(N, neighborhood, numPeriods, backend, shots, trialBound, rhoBudget):
+    if N < 3:
+        return True, False, None
 
-        a = pick(N)
-        while a < 2:
-            a = pick(N)
+    done, factors = classicalShortcut(N, trialBound, rhoBudget)
+    if done:
+        return True, factors, None
 
-        d = gcd(a, N)
-        if d > 1:
-            printInfo("Found factors classically, re-attempt")
-            continue
+    # Only backends that simulate are held to BIT_LIMIT
+    if N.bit_length() > BIT_LIMIT and not backend_class(backend).classical:
+        return True, False, None
 
-        r = findPeriod(a, N)
+    neighborhood = math.floor(N * neighborhood) + 1
+    printSettings(N, neighborhood, numPeriods, shots)
+    return False, None, neighborhood
 
-        printInfo("Checking candidate period, nearby values, and multiples")
+# Returns two factors of N, or [N] alone if N is prime. None means no
+# attempt found enough periods, False that N is below 3 or too big to simulate.
+@timed("shors")
+def shors(N, attempts = 1, neighborhood = 0.0, numPeriods = 1, backend = None, shots = 1, kMax = None, trialBound = 0, rhoBudget = 0):
+    done, factors, neighborhood = prepare(N, neighborhood, numPeriods, backend, shots, trialBound, rhoBudget)
+    if done:
+        return factors
 
-        r = checkCandidates(a, r, N, neighborhood)
+    periods = []
 
-        if r is None:
-            printInfo("Period was not found, re-attempt")
-            continue
+    for attempt in range(attempts):
+        printInfo("\nAttempt #" + str(attempt))
+        count("attempts")
 
-        if (r % 2) > 0:
-            printInfo("Period was odd, re-attempt")
+        a = pickCoprime(N)
+        if a is None:
             continue
 
-        d = modExp(a, (r // 2), N)
-        if r == 0 or d == (N - 1):
-            printInfo("Period was trivial, re-attempt")
-            continue
+        for r in attemptPeriods(a, N, neighborhood, backend, shots, kMax):
+            printInfo("Period found\tr = " + str(r))
 
-        printInfo("Period found\tr = " + str(r))
+            periods.append(r)
+            if(len(periods) < numPeriods):
+                continue
 
-        periods.append(r)
-        if(len(periods) < numPeriods):
-            continue
+            return factorsFromPeriods(a, periods, N)
 
-        printInfo("\nFinding least common multiple of all periods")
+    return None
 
-        r = 1
-        for period in periods:
-            d = gcd(period, r)
-            r = (r * period) // d
+####################################################################################################
+#                                                                                                   
+#                                         Parallel Attempts                                         
+#                                                                                                   
+####################################################################################################
 
-        b = modExp(a, (r // 2), N)
-        f1 = gcd(N, b + 1)
-        f2 = gcd(N, b - 1)
+def initWorker(cacheDir, verbose):
+    # Workers may be spawned rather than forked, so don't rely on inherited state
+    global printInfo
+    printInfo = printVerbose if verbose else printNone
+    circuit_cache.directory = cacheDir
+    # Forked workers would otherwise all draw the same measurements, from
+    # the global stream and from any backend the parent already made
+    np.random.seed()
+    reseed_all()
+
+def runAttempt(job):
+    a, N, neighborhood, backend, shots, kMax = job
+    return a, attemptPeriods(a, N, neighborhood, backend, shots, kMax)
+
+# Same as shors, but the attempts run concurrently on a pool of worker
+# processes. Bases are picked up front, results are used in the order they
+# finish, and the pool is torn down (killing attempts still running) as soon
+# as numPeriods periods are in. backend must be a name, so it can be sent to
+# the workers.
+@timed("shorsParallel")
+def shorsParallel(N, attempts = 1, neighborhood = 0.0, numPeriods = 1, backend = None, shots = 1, kMax = None, trialBound = 0, rhoBudget = 0, workers = None):
+    done, factors, neighborhood = prepare(N, neighborhood, numPeriods, backend, shots, trialBound, rhoBudget)
+    if done:
+        return factors
 
-        return [f1, f2]
+    periods = []
+
+    bases = [pickCoprime(N) for attempt in range(attempts)]
+    jobs = [(a, N, neighborhood, backend, shots, kMax) for a in bases if a is not None]
+    if len(jobs) == 0:
+        return None
+
+    verbose = printInfo is printVerbose
+    pool = multiprocessing.Pool(workers, initWorker, (circuit_cache.directory, verbose))
+    try:
+        for a, found in pool.imap_unordered(runAttempt, jobs):
+            count("attempts")
+            for r in found:
+                printInfo("Period found\tr = " + str(r))
+
+                periods.append(r)
+                if(len(periods) < numPeriods):
+                    continue
+
+                return factorsFromPeriods(a, periods, N)
+    finally:
+        pool.terminate()
+        pool.join()
 
     return None
 
@@ -226,7 +421,22 @@ def parseArgs():
     parser.add_argument('-a', '--attempts', type=int, default=20, help='Number of quantum attemtps to perform')
     parser.add_argument('-n', '--neighborhood', type=float, default=0.01, help='Neighborhood size for checking candidates (as percentage of N)')
     parser.add_argument('-p', '--periods', type=int, default=2, help='Number of periods to get before determining least common multiple')
+    parser.add_argument('-s', '--shots', type=int, default=8, help='Number of measurements to take from each period finding circuit')
+    parser.add_argument('-b', '--backend', choices=sorted(BACKENDS), default=DEFAULT_BACKEND, help='Backend to run the period finding on')
+    parser.add_argument('-k', '--k-max', type=int, default=None, help='Drop rotations of 2pi/2^k with k above this (approximate QFT)')
+    parser.add_argument('-t', '--trial-bound', type=int, default=0, help='Try dividing N by everything up to this before going quantum')
+    parser.add_argument('-r', '--rho-budget', type=int, default=0, help='Steps of Pollard\'s rho to try before going quantum')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='Number of processes to run attempts on concurrently')
+    parser.add_argument('-c', '--cache-dir', default=None, help='Directory to keep built circuits in between runs')
     parser.add_argument('-v', '--verbose', type=bool, default=True, help='Verbose')
+    parser.add_argument('--storage', default=None, help='Keep the simulator\'s amplitudes in a memory-mapped file in this directory')
+    parser.add_argument('--single', action='store_true', help='Simulate in single precision (complex64)')
+    parser.add_argument('--threads', type=int, default=1, help='Number of threads the simulator applies gates on')
+    parser.add_argument('--bit-limit', type=int, default=BIT_LIMIT, help='Largest N in bits to simulate')
+    parser.add_argument('--metrics', action='store_true', help='Print time spent per stage and counters when done, for the main process only with -w')
+    parser.add_argument('--trace', default=None, help='Write a Chrome trace event file of the run')
+    parser.add_argument('--memory', action='store_true', help='Track memory with tracemalloc in the metrics, implies --metrics')
+    parser.add_argument('--profile', nargs='?', const='-', default=None, help='Run under cProfile, writing stats to this file or a summary to stderr')
     parser.add_argument('N', type=int, help='The integer to factor')
     return parser.parse_args()
 
@@ -239,8 +449,41 @@ def main():
     else:
         printInfo = printNone
 
-    factors = shors(args.N, args.attempts, args.neighborhood, args.periods)
-    if factors is not None:
+    circuit_cache.directory = args.cache_dir
+
+    global BIT_LIMIT
+    BIT_LIMIT = args.bit_limit
+    if args.storage or args.single or args.threads > 1:
+        if not issubclass(BACKENDS[args.backend], SimulatorBackend):
+            sys.exit("--storage, --single and --threads need a simulator backend")
+        configure(args.backend, dtype = np.complex64 if args.single else np.complex128, storage = args.storage, threads = args.threads)
+
+    args.metrics = args.metrics or args.memory
+    if args.metrics or args.trace:
+        metrics.enable(memory = args.memory)
+    profile = nullcontext()
+    if args.profile is not None:
+        profile = metrics.profiled(None if args.profile == '-' else args.profile)
+
+    with profile:
+        if args.workers > 1:
+            factors = shorsParallel(args.N, args.attempts, args.neighborhood, args.periods, args.backend, args.shots, args.k_max, args.trial_bound, args.rho_budget, args.workers)
+        else:
+            factors = shors(args.N, args.attempts, args.neighborhood, args.periods, args.backend, args.shots, args.k_max, args.trial_bound, args.rho_budget)
+
+    recorder = metrics.recorder()
+    if recorder is not None:
+        if args.trace:
+            recorder.write_trace(args.trace)
+        if args.metrics:
+            print(recorder.format_summary(), file = sys.stderr)
+        metrics.disable()
+
+    if factors is False:
+        sys.exit("N must be at least 3, and at most {} bits unless it factors classically".format(BIT_LIMIT))
+    if factors is not None and len(factors) == 1:
+        print(str(args.N) + " is prime")
+    elif factors is not None:
         print("Factors:\t" + str(factors[0]) + ", " + str(factors[1]))
 
 if __name__ == "__main__":
@@ -0,0 +1,556 @@
+"""simulator.py: in-process NumPy statevector simulator for pyQuil programs
+
+By default the amplitudes live in memory as complex128. A Simulator given a
+storage directory keeps them in a memory-mapped file there instead, and
+applies gates a chunk of 2**chunk_qubits amplitudes at a time, so the state
+can be far larger than RAM. dtype=np.complex64 halves the size either way.
+
+With threads > 1 the same block passes are spread over a thread pool, the
+state cut into at least one block per thread. Which axes a pass blocks on
+depends on the qubits its gates touch, so gates on any qubit stay local to a
+block and the reshuffling between passes happens through the shared array.
+NumPy releases the GIL in the contractions and copies that do the work.
+"""
+
+import itertools
+import os
+import tempfile
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from pyquil.gate_matrices import QUANTUM_GATES
+from pyquil.quil import Program
+from pyquil.quilatom import MemoryReference, substitute_array
+from pyquil.quilbase import (Gate, Measurement, Declare, DefGate, Jump, JumpWhen,
+                             JumpUnless, JumpTarget, Halt, Pragma, Nop)
+
+from circuit import PHASE_BITS
+
+
+def gate_matrix(gate, defined_gates):
+    # Look up (or evaluate) the unitary for a gate, then apply its modifiers
+    # from the innermost outwards, the same way the QVM reads them.
+    if gate.name in defined_gates:
+        defn = defined_gates[gate.name]
+        if defn.parameters:
+            subs = dict(zip(defn.parameters, gate.params))
+            matrix = substitute_array(defn.matrix, subs)
+        else:
+            matrix = defn.matrix
+    elif gate.name in QUANTUM_GATES:
+        matrix = QUANTUM_GATES[gate.name]
+        if gate.params:
+            matrix = matrix(*gate.params)
+    else:
+        raise ValueError("Unknown gate {}".format(gate.name))
+    matrix = np.asarray(matrix, dtype=np.complex128)
+
+    for modifier in reversed(gate.modifiers):
+        if modifier == "DAGGER":
+            matrix = matrix.conj().T
+        elif modifier == "CONTROLLED":
+            dim = matrix.shape[0]
+            controlled = np.eye(2*dim, dtype=np.complex128)
+            controlled[dim:, dim:] = matrix
+            matrix = controlled
+        else:
+            raise ValueError("Unsupported gate modifier {}".format(modifier))
+    return matrix
+
+
+def circuit_matrix(name, arg, dagger):
+    # Unitary for a Circuit op. The RK and PHASE families are diagonal with a
+    # single phase on the all ones state.
+    if name in ("RK", "CRK", "CCRK"):
+        dim = 2**(len(name) - 1)
+        matrix = np.eye(dim, dtype=np.complex128)
+        matrix[-1, -1] = np.exp((-1 if dagger else 1) * 2j*np.pi / 2**arg)
+        return matrix
+    if name in ("PHASE", "CPHASE", "CCPHASE"):
+        dim = 2**(len(name) - 4)
+        matrix = np.eye(dim, dtype=np.complex128)
+        matrix[-1, -1] = np.exp((-1 if dagger else 1) * 2j*np.pi * arg / 2**PHASE_BITS)
+        return matrix
+    matrix = np.asarray(QUANTUM_GATES[name], dtype=np.complex128)
+    return matrix.conj().T if dagger else matrix
+
+
+def apply_matrix(state, matrix, axes):
+    # Contract a k-qubit unitary against the given axes of the state tensor.
+    # The first qubit of the gate is the most significant bit of the matrix
+    # index, matching pyQuil's ordering.
+    k = len(axes)
+    tensor = matrix.reshape((2,)*(2*k))
+    state = np.tensordot(tensor, state, axes=(list(range(k, 2*k)), axes))
+    return np.moveaxis(state, list(range(k)), axes)
+
+
+def apply_diagonal(state, diagonal, axes):
+    # Multiply in a diagonal held as a tensor over the given axes, which are
+    # in increasing order
+    shape = [1]*state.ndim
+    for axis in axes:
+        shape[axis] = 2
+    return state * diagonal.reshape(shape)
+
+
+# Runs of diagonal gates are merged while they touch at most this many qubits
+DIAGONAL_MAX_QUBITS = 16
+
+def fuse_diagonals(ops, max_qubits=DIAGONAL_MAX_QUBITS):
+    # Replaces each run of consecutive diagonal GATE ops with one DIAGONAL op
+    # holding the product of their diagonals, so the run costs a single
+    # elementwise multiply over the state instead of a contraction per gate.
+    # Diagonal gates commute, so only H, CNOT, measurements and the like end
+    # a run. Op indices change, so ops must not contain jumps.
+    fused = []
+    run = []
+    support = set()
+
+    def flush():
+        if not run:
+            return
+        axes = sorted(support)
+        diagonal = np.ones((2,)*len(axes), dtype=np.complex128)
+        for values, gate_axes in run:
+            diagonal = diagonal * diagonal_factor(values, gate_axes, axes)
+        fused.append(("DIAGONAL", diagonal, axes))
+        del run[:]
+        support.clear()
+
+    for op in ops:
+        if op[0] == "GATE" and is_diagonal(op[1]):
+            if len(support | set(op[2])) > max_qubits:
+                flush()
+            run.append((np.diag(op[1]), op[2]))
+            support.update(op[2])
+        else:
+            flush()
+            fused.append(op)
+    flush()
+    return fused
+
+def is_diagonal(matrix):
+    return not np.count_nonzero(matrix - np.diag(np.diag(matrix)))
+
+def diagonal_factor(values, gate_axes, axes):
+    # The diagonal of a gate on gate_axes, first axis most significant, as a
+    # tensor broadcastable over the sorted axes
+    tensor = values.reshape((2,)*len(gate_axes)).transpose(np.argsort(gate_axes))
+    return tensor.reshape([2 if axis in gate_axes else 1 for axis in axes])
+
+
+def block_indices(num_axes, local):
+    # Index tuples picking out each block of the state that spans the local
+    # axes, in memory order
+    fixed = [axis for axis in range(num_axes) if axis not in local]
+    for values in itertools.product((0, 1), repeat=len(fixed)):
+        index = [slice(None)]*num_axes
+        for axis, value in zip(fixed, values):
+            index[axis] = value
+        yield tuple(index)
+
+def local_axes(num_axes, support, chunk_qubits):
+    # The axes held in each block, the ones ops act on plus the fastest
+    # varying others, so blocks are as close to contiguous as possible
+    support = sorted(set(support))
+    rest = [axis for axis in range(num_axes-1, -1, -1) if axis not in support]
+    return sorted(support + rest[:max(chunk_qubits - len(support), 0)])
+
+def for_blocks(function, indices, pool=None):
+    # Blocks never overlap, so they can be worked on in any order
+    if pool is None:
+        return [function(index) for index in indices]
+    return list(pool.map(function, indices))
+
+def apply_pass(state, run, chunk_qubits, pool=None):
+    # Applies a run of GATE and DIAGONAL ops in one sweep over the state,
+    # loading each block once for all of them and writing it back in place
+    local = local_axes(state.ndim, [axis for op in run for axis in op[2]], chunk_qubits)
+    position = {axis: i for i, axis in enumerate(local)}
+
+    def update(index):
+        block = np.array(state[index])
+        for kind, matrix, axes in run:
+            axes = [position[axis] for axis in axes]
+            if kind == "GATE":
+                block = apply_matrix(block, matrix, axes)
+            else:
+                block = apply_diagonal(block, matrix, axes)
+        state[index] = block
+
+    for_blocks(update, block_indices(state.ndim, local), pool)
+
+def measure_chunked(state, axis, rng, chunk_qubits, pool=None):
+    # measure, in place, a block at a time
+    local = local_axes(state.ndim, [axis], chunk_qubits)
+    position = local.index(axis)
+    p1 = sum(for_blocks(lambda index: np.sum(np.abs(np.take(state[index], 1, axis=position))**2),
+                        block_indices(state.ndim, local), pool))
+    bit = int(rng.random_sample() < p1)
+    norm = np.sqrt(p1 if bit else 1 - p1)
+
+    def collapse(index):
+        block = np.moveaxis(np.array(state[index]), position, 0)
+        block[1 - bit] = 0
+        block[bit] /= norm
+        state[index] = np.moveaxis(block, 0, position)
+
+    for_blocks(collapse, block_indices(state.ndim, local), pool)
+    return bit
+
+def sample_chunked(state, trials, rng, chunk_qubits):
+    # Basis state indices drawn from |state|**2 by inverting its running
+    # total, one chunk of the flattened state at a time. Takes the same
+    # uniforms as rng.choice, so a seed draws what it would in memory.
+    flat = state.reshape(-1)
+    size = 1 << chunk_qubits
+    weights = np.array([np.sum(np.abs(flat[i:i+size])**2) for i in range(0, len(flat), size)])
+    totals = np.cumsum(weights)
+    targets = rng.random_sample(trials) * totals[-1]
+    chunks = np.minimum(totals.searchsorted(targets, side="right"), len(weights) - 1)
+    samples = np.zeros(trials, dtype=np.int64)
+    for chunk in np.unique(chunks):
+        running = np.cumsum(np.abs(flat[chunk*size:(chunk+1)*size])**2)
+        picked = chunks == chunk
+        within = targets[picked] - (totals[chunk-1] if chunk else 0)
+        samples[picked] = chunk*size + np.minimum(running.searchsorted(within, side="right"), len(running) - 1)
+    return samples
+
+
+def measure(state, axis, rng):
+    # Projectively measure one axis, returning the bit and the collapsed state.
+    state = np.moveaxis(state, axis, 0)
+    p1 = np.sum(np.abs(state[1])**2)
+    bit = int(rng.random_sample() < p1)
+    norm = np.sqrt(p1 if bit else 1 - p1)
+    collapsed = np.zeros_like(state)
+    collapsed[bit] = state[bit] / norm
+    return bit, np.moveaxis(collapsed, 0, axis)
+
+
+# Amplitudes per block of a memory-mapped state, 16 MiB at complex128
+CHUNK_QUBITS = 20
+
+# Smaller states fit in cache, where threads only add overhead
+THREADED_MIN_QUBITS = 18
+
+class Simulator(object):
+    """Runs pyQuil programs or Circuits on a local statevector, mirroring QVMConnection.run"""
+
+    def __init__(self, random_seed=None, dtype=np.complex128, storage=None, chunk_qubits=CHUNK_QUBITS,
+                 threads=1):
+        self.rng = np.random.RandomState(random_seed)
+        self.dtype = np.dtype(dtype)
+        self.storage = storage
+        self.chunk_qubits = chunk_qubits
+        self.threads = threads
+        self._pool = None
+
+    def pool(self):
+        # The thread pool, started on first use, or None when single threaded
+        if self.threads > 1 and self._pool is None:
+            self._pool = ThreadPoolExecutor(self.threads)
+        return self._pool
+
+    def close(self):
+        # Shuts the thread pool down, a later run starts a new one
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def block_qubits(self, num_qubits):
+        # Qubits per block of a chunked pass, leaving a block per thread
+        return min(self.chunk_qubits, max(num_qubits - (self.threads - 1).bit_length(), 0))
+
+    def zero_state(self, num_qubits):
+        if self.storage is None:
+            return zero_state(num_qubits, self.dtype)
+        # The file is unlinked straight away, the mapping keeps it alive for
+        # as long as the state is referenced
+        fd, path = tempfile.mkstemp(suffix=".amplitudes", dir=self.storage)
+        try:
+            state = np.memmap(path, dtype=self.dtype, mode="w+", shape=(2,)*num_qubits)
+        finally:
+            os.close(fd)
+            os.unlink(path)
+        state[(0,)*num_qubits] = 1
+        return state
+
+    def compile(self, program):
+        # Resolve a program once into a flat list of ops so repeated trials
+        # don't redo the matrix lookups or label resolution.
+        if not isinstance(program, Program):
+            return self.compile_circuit(program)
+        defined_gates = {dg.name: dg for dg in program.defined_gates}
+        instructions = program.instructions
+        qubits = sorted(program.get_qubits())
+        axis_of = {q: i for i, q in enumerate(qubits)}
+
+        labels = {}
+        for idx, inst in enumerate(instructions):
+            if isinstance(inst, JumpTarget):
+                labels[inst.label.name] = idx
+
+        matrices = {}
+        memory = {}
+        ops = []
+        for inst in instructions:
+            if isinstance(inst, Gate):
+                key = (inst.name, tuple(inst.params), tuple(inst.modifiers))
+                if key not in matrices:
+                    matrices[key] = gate_matrix(inst, defined_gates)
+                axes = [axis_of[q.index] for q in inst.qubits]
+                ops.append(("GATE", matrices[key], axes))
+            elif isinstance(inst, Measurement):
+                reg = inst.classical_reg
+                target = None if reg is None else (reg.name, reg.offset)
+                ops.append(("MEASURE", axis_of[inst.qubit.index], target))
+            elif isinstance(inst, Declare):
+                memory[inst.name] = inst.memory_size
+                ops.append(("NOP",))
+            elif isinstance(inst, JumpWhen):
+                ops.append(("JUMP-WHEN", labels[inst.target.name], _address(inst.condition)))
+            elif isinstance(inst, JumpUnless):
+                ops.append(("JUMP-UNLESS", labels[inst.target.name], _address(inst.condition)))
+            elif isinstance(inst, Jump):
+                ops.append(("JUMP", labels[inst.target.name]))
+            elif isinstance(inst, Halt):
+                ops.append(("HALT",))
+            elif isinstance(inst, (JumpTarget, Pragma, Nop, DefGate)):
+                ops.append(("NOP",))
+            else:
+                raise ValueError("Unsupported instruction {}".format(inst))
+        if not labels:
+            ops = fuse_diagonals(ops)
+        return cast_ops(ops, self.dtype), len(qubits), memory
+
+    def compile_circuit(self, circuit):
+        # Circuits, and fuse.FusedCircuits, already use qubit indices
+        # 0..num_qubits-1 as the axes, and conditional ops check their ro bit
+        # directly instead of jumping
+        matrices = {}
+        ops = []
+        for name, arg, qubits, dagger, cond in circuit.ops():
+            if name == "MEASURE":
+                ops.append(("MEASURE", qubits[0], ("ro", arg)))
+                continue
+            if name == "FUSED":
+                # A block from fuse.py, arg indexes its unitaries
+                ops.append(("GATE", circuit.matrices[arg], list(qubits)))
+                continue
+            key = (name, arg, dagger)
+            if key not in matrices:
+                matrices[key] = circuit_matrix(name, arg, dagger)
+            if cond is None:
+                ops.append(("GATE", matrices[key], list(qubits)))
+            else:
+                ops.append(("GATE-WHEN", matrices[key], list(qubits), ("ro", cond)))
+        memory = {"ro": circuit.num_bits} if circuit.num_bits else {}
+        return cast_ops(fuse_diagonals(ops), self.dtype), circuit.num_qubits, memory
+
+    def execute(self, ops, num_qubits, memory, state=None):
+        # Starts from |0...0> unless given a state tensor to continue from
+        if state is None:
+            state = self.zero_state(num_qubits)
+        mem = {name: np.zeros(size, dtype=np.int8) for name, size in memory.items()}
+        chunked = isinstance(state, np.memmap) or (self.threads > 1 and num_qubits >= THREADED_MIN_QUBITS)
+        block_qubits = self.block_qubits(num_qubits)
+        pc = 0
+        while pc < len(ops):
+            if chunked and ops[pc][0] in PASS_OPS:
+                run, pc = gather_pass(ops, pc, mem, block_qubits)
+                if run:
+                    apply_pass(state, run, block_qubits, self.pool())
+                continue
+            op = ops[pc]
+            kind = op[0]
+            pc += 1
+            if chunked and kind == "MEASURE":
+                bit = measure_chunked(state, op[1], self.rng, block_qubits, self.pool())
+                if op[2] is not None:
+                    mem[op[2][0]][op[2][1]] = bit
+            elif kind == "GATE":
+                state = apply_matrix(state, op[1], op[2])
+            elif kind == "DIAGONAL":
+                state = apply_diagonal(state, op[1], op[2])
+            elif kind == "GATE-WHEN":
+                if mem[op[3][0]][op[3][1]]:
+                    state = apply_matrix(state, op[1], op[2])
+            elif kind == "MEASURE":
+                bit, state = measure(state, op[1], self.rng)
+                if op[2] is not None:
+                    mem[op[2][0]][op[2][1]] = bit
+            elif kind == "JUMP-WHEN":
+                if mem[op[2][0]][op[2][1]]:
+                    pc = op[1]
+            elif kind == "JUMP-UNLESS":
+                if not mem[op[2][0]][op[2][1]]:
+                    pc = op[1]
+            elif kind == "JUMP":
+                pc = op[1]
+            elif kind == "HALT":
+                break
+        return state, mem
+
+    def session(self, num_qubits):
+        return Session(self, num_qubits)
+
+    def wavefunction(self, program):
+        ops, num_qubits, memory = self.compile(program)
+        state, _ = self.execute(ops, num_qubits, memory)
+        # Flatten with qubit 0 as the least significant bit, like the QVM does
+        return state.transpose(list(reversed(range(num_qubits)))).reshape(-1)
+
+    def evolve(self, program, states):
+        # Applies a program without measurements or control flow to a whole
+        # batch of states at once. states has shape (batch, 2**num_qubits),
+        # flattened like wavefunction with qubit 0 least significant.
+        ops, num_qubits, _ = self.compile(program)
+        batch = len(states)
+        # Put qubit i on axis i+1, behind the batch axis
+        state = np.asarray(states, dtype=self.dtype).reshape((batch,) + (2,)*num_qubits)
+        state = state.transpose([0] + list(range(num_qubits, 0, -1)))
+        for op in ops:
+            if op[0] == "GATE":
+                state = apply_matrix(state, op[1], [axis + 1 for axis in op[2]])
+            elif op[0] == "DIAGONAL":
+                state = apply_diagonal(state, op[1], [axis + 1 for axis in op[2]])
+            elif op[0] != "NOP":
+                raise ValueError("evolve can't run {} ops".format(op[0]))
+        return state.transpose([0] + list(range(num_qubits, 0, -1))).reshape(batch, -1)
+
+    def run(self, program, classical_addresses=None, trials=1):
+        ops, num_qubits, memory = self.compile(program)
+        if "ro" not in memory:
+            return []
+        if classical_addresses is None:
+            classical_addresses = list(range(memory["ro"]))
+
+        tail = _terminal_measurements(ops)
+        if tail is not None:
+            return self._sample(ops[:tail], ops[tail:], num_qubits, memory,
+                                classical_addresses, trials)
+
+        results = []
+        for _ in range(trials):
+            _, mem = self.execute(ops, num_qubits, memory)
+            results.append([int(mem["ro"][i]) for i in classical_addresses])
+        return results
+
+    def _sample(self, ops, terminal, num_qubits, memory, classical_addresses, trials):
+        # Every measurement comes after the last gate with no feedback, so the
+        # state can be prepared once and all trials drawn from its distribution.
+        state, _ = self.execute(ops, num_qubits, memory)
+        if isinstance(state, np.memmap):
+            samples = sample_chunked(state, trials, self.rng, self.chunk_qubits)
+        else:
+            probs = np.abs(state.reshape(-1))**2
+            samples = self.rng.choice(len(probs), size=trials, p=probs/probs.sum())
+        results = np.zeros((trials, memory["ro"]), dtype=np.int8)
+        for op in terminal:
+            if op[0] != "MEASURE":
+                continue
+            _, axis, target = op
+            if target is not None and target[0] == "ro":
+                results[:, target[1]] = (samples >> (num_qubits - 1 - axis)) & 1
+        return results[:, classical_addresses].tolist()
+
+
+class Session(object):
+    """A statevector that lives on between Circuits
+
+    Each run applies a Circuit to the state the previous one left behind and
+    returns what it measured, so a long computation can be sent a piece at a
+    time, with the host choosing the next piece from the measurements so far.
+    Classical memory only lasts for one run.
+    """
+
+    def __init__(self, simulator, num_qubits):
+        self.simulator = simulator
+        self.num_qubits = num_qubits
+        self.state = simulator.zero_state(num_qubits)
+
+    def compile(self, circuit):
+        # Compiles a Circuit once, for run to apply as often as needed, in
+        # this session or another of the same simulator
+        if isinstance(circuit, Program) or circuit.num_qubits != self.num_qubits:
+            raise ValueError("a session runs Circuits on its own {} qubits".format(self.num_qubits))
+        return Compiled(*self.simulator.compile_circuit(circuit))
+
+    def run(self, circuit):
+        # Runs a Circuit, or what compile made of one, and returns its ro
+        # bits as a list
+        if not isinstance(circuit, Compiled):
+            circuit = self.compile(circuit)
+        self.state, mem = self.simulator.execute(circuit.ops, circuit.num_qubits, circuit.memory, self.state)
+        return [int(bit) for bit in mem.get("ro", [])]
+
+# A Circuit compiled by Session.compile
+Compiled = namedtuple("Compiled", ["ops", "num_qubits", "memory"])
+
+
+def zero_state(num_qubits, dtype=np.complex128):
+    state = np.zeros((2,)*num_qubits, dtype=dtype)
+    state[(0,)*num_qubits] = 1
+    return state
+
+
+def cast_ops(ops, dtype):
+    # Matrices in the state's precision, so single precision states stay so
+    if dtype == np.complex128:
+        return ops
+    return [op[:1] + (op[1].astype(dtype),) + op[2:] if op[0] in MATRIX_OPS else op
+            for op in ops]
+
+MATRIX_OPS = ("GATE", "GATE-WHEN", "DIAGONAL")
+
+# Ops a chunked pass can take in, GATE-WHENs once their bit is known
+PASS_OPS = ("GATE", "GATE-WHEN", "DIAGONAL", "NOP")
+
+def gather_pass(ops, pc, mem, chunk_qubits):
+    # The ops from pc on that fit in one pass over blocks of chunk_qubits,
+    # and where the pass ends. A single op wider than that gets a pass of
+    # its own with bigger blocks.
+    run = []
+    support = set()
+    while pc < len(ops) and ops[pc][0] in PASS_OPS:
+        op = ops[pc]
+        if op[0] == "NOP" or (op[0] == "GATE-WHEN" and not mem[op[3][0]][op[3][1]]):
+            pc += 1
+            continue
+        if run and len(support | set(op[2])) > chunk_qubits:
+            break
+        kind = "GATE" if op[0] == "GATE-WHEN" else op[0]
+        run.append((kind, op[1], op[2]))
+        support.update(op[2])
+        pc += 1
+    return run, pc
+
+
+def _address(condition):
+    if isinstance(condition, MemoryReference):
+        return (condition.name, condition.offset)
+    raise ValueError("Unsupported jump condition {}".format(condition))
+
+
+def _terminal_measurements(ops):
+    # Returns where the trailing run of measurements starts if nothing before
+    # it depends on classical state, otherwise None.
+    tail = len(ops)
+    while tail > 0 and ops[tail-1][0] in ("MEASURE", "NOP"):
+        tail -= 1
+    if any(op[0] not in ("GATE", "DIAGONAL", "NOP") for op in ops[:tail]):
+        return None
+    measured = [op[1] for op in ops[tail:] if op[0] == "MEASURE"]
+    if len(measured) != len(set(measured)):
+        return None
+    return tail
@@ -1,134 +1,437 @@
+import random
+import tempfile
+
 from period import *
+from circuit import Circuit
+import simulator
+from simulator import Simulator
+from emulator import emulate, pack, unpack
+from fuse import fuse
+from backends import SequentialBackend, SimulatorBackend, order, shor_samples
+import shors
+from numbertheory import modExp
+from shors import cfBatch, checkCandidatesBatch, perfectPower, preScreen, trialDivision
 
-def test_adder(size):
-    print("Starting the adder test for numbers of size {}".format(size))
-    b = QubitPlaceholder.register(size+1)
-    c1 = QubitPlaceholder()
-    c2 = QubitPlaceholder()
-    all_passed = True
-    for i in range(2**size):
-        for j in range(2**size):
-            p = Program()
-            p += get_defs()
-            p += write_in(i, b)
-
-            p += X(c1)
-            p += X(c2)
-            p += QFT(b)
-            p += CCPSIADDER(c1, c2, b, j)
-            p += REVERSE(QFT(b))
-
-            outp, prog = read_out(p, b)
-            res = i+j == outp
-            if not res:
-                print("-"*10)
-                print("b = {:4b}\na = {:4b}\n+ = {:4b} ({})".format(i, j, outp, res))
-                all_passed = False
+# Each test builds one circuit per classical setting (N and a) and runs every
+# basis input through it at once, as a batch of states on the local
+# simulator. Qubits are plain indices, with b first. The functions also run
+# under pytest, at the default sizes.
+
+def basis_states(indices, num_qubits):
+    states = np.zeros((len(indices), 2**num_qubits), dtype=np.complex128)
+    states[np.arange(len(indices)), indices] = 1
+    return states
+
+def register_index(values, reg):
+    # Basis state index with values written into reg, qubit 0 least significant
+    index = np.zeros_like(values)
+    for i, q in enumerate(reg):
+        index |= ((values >> i) & 1) << q
+    return index
+
+def read_register(states, reg, num_qubits):
+    # Distribution of the value held in reg, for every state in the batch
+    probs = np.abs(states.reshape((len(states),) + (2,)*num_qubits))**2
+    # Axis 1 holds the most significant qubit
+    axes = [num_qubits - q for q in reg]
+    kept = sorted(axes)
+    probs = probs.sum(axis=tuple(a for a in range(1, num_qubits+1) if a not in axes))
+    order = [kept.index(a) + 1 for a in reversed(axes)]
+    return probs.transpose([0] + order).reshape(len(states), -1)
+
+def check_batch(ops, inputs, reg, expected, num_qubits):
+    # Runs the basis states inputs through ops and returns, per input,
+    # whether reg certainly holds expected, and the value most likely found
+    states = Simulator().evolve(Circuit.from_ops(ops, num_qubits), basis_states(inputs, num_qubits))
+    probs = read_register(states, reg, num_qubits)
+    outp = probs.argmax(axis=1)
+    passed = (outp == expected) & (probs.max(axis=1) > 1 - 1e-6)
+    return passed, outp
+
+def report(all_passed):
     if not all_passed:
         print("Uh-oh, there were errors")
     else:
         print("Success, all tests passed")
+    assert all_passed
 
-def test_mod_adder(size):
+def test_adder(size=3):
     print("Starting the adder test for numbers of size {}".format(size))
-    b = QubitPlaceholder.register(size+1)
-    c1 = QubitPlaceholder()
-    c2 = QubitPlaceholder()
-    zero = QubitPlaceholder()
+    b = list(range(size+1))
+    c1, c2 = size+1, size+2
+    num_qubits = size+3
+    i = np.arange(2**size)
     all_passed = True
-    for N in range(0, 2**size):
-        for i in range(0, N):
-            for j in range(0, N):
-                p = Program()
-                p += get_defs()
-                p += write_in(i, b)
-
-                p += X(c1)
-                p += X(c2)
-                p += QFT(b)
-                p += PSIADDERMOD(c1, c2, b, j, N, zero)
-                p += REVERSE(QFT(b))
-
-                outp, prog = read_out(p, b)
-                expected = (i+j)%N
-                res = expected == outp
-                if not res:
-                    print("-"*10)
-                    print("b = {:8b}\na = {:8b}\nN = {:8b}\n+ = {:8b} != {:8f} ({})".format(i, j, N, outp, expected, res))
-                    all_passed = False
-    if not all_passed:
-        print("Uh-oh, there were errors")
-    else:
-        print("Success, all tests passed")
+    for j in range(2**size):
+        ops = [("X", 0, (c1,), False, None), ("X", 0, (c2,), False, None)]
+        ops += qft_gates(b)
+        ops += psiadder_gates((c1, c2), b, j)
+        ops += reverse_gates(qft_gates(b))
 
+        passed, outp = check_batch(ops, register_index(i, b), b, i+j, num_qubits)
+        for n in np.flatnonzero(~passed):
+            print("-"*10)
+            print("b = {:4b}\na = {:4b}\n+ = {:4b} ({})".format(i[n], j, outp[n], False))
+            all_passed = False
+    report(all_passed)
 
-def test_cmult(size):
+def test_mod_adder(size=3):
     print("Starting the adder test for numbers of size {}".format(size))
-    b = QubitPlaceholder.register(size+1)
-    x = QubitPlaceholder.register(size)
-    c1 = QubitPlaceholder()
-    zero = QubitPlaceholder()
+    b = list(range(size+1))
+    c1, c2, zero = size+1, size+2, size+3
+    num_qubits = size+4
     all_passed = True
-    for N in range(0, 2**size):
-        for i in range(0, N):
-            for j in range(0, 2**size):
-                for k in range(0, 2**size):
-                    p = Program()
-                    p += get_defs()
-
-                    p += write_in(i, b)
-                    p += write_in(k, x)
-
-                    p += X(c1)
-                    # this takes x, b to x, b + a*x mod N
-                    p += CMULTMOD(c1, x, b, j, N, zero)
-
-                    outp, prog = read_out(p, b)
-                    expected = (i+j*k)%N
-                    res = expected == outp
-                    if not res:
-                        print("-"*10)
-                        print("b = {:8b}\na = {:8b}\nN = {:8b}\n+ = {:8b} != {:8f} ({})".format(i, j, N, outp, expected, res))
-                        all_passed = False
-    if not all_passed:
-        print("Uh-oh, there were errors")
-    else:
-        print("Success, all tests passed")
+    for N in range(1, 2**size):
+        i = np.arange(N)
+        for j in range(0, N):
+            ops = [("X", 0, (c1,), False, None), ("X", 0, (c2,), False, None)]
+            ops += qft_gates(b)
+            ops += psiaddermod_gates(c1, c2, b, j, N, zero)
+            ops += reverse_gates(qft_gates(b))
 
-def test_ua(size):
+            expected = (i+j)%N
+            passed, outp = check_batch(ops, register_index(i, b), b, expected, num_qubits)
+            for n in np.flatnonzero(~passed):
+                print("-"*10)
+                print("b = {:8b}\na = {:8b}\nN = {:8b}\n+ = {:8b} != {:8f} ({})".format(i[n], j, N, outp[n], expected[n], False))
+                all_passed = False
+    report(all_passed)
+
+
+def test_cmult(size=3):
+    print("Starting the adder test for numbers of size {}".format(size))
+    b = list(range(size+1))
+    x = list(range(size+1, 2*size+1))
+    c1, zero = 2*size+1, 2*size+2
+    num_qubits = 2*size+3
+    all_passed = True
+    for N in range(1, 2**size):
+        # Every b < N against every x
+        i, k = [v.reshape(-1) for v in np.meshgrid(np.arange(N), np.arange(2**size))]
+        inputs = register_index(i, b) | register_index(k, x)
+        for j in range(0, 2**size):
+            ops = [("X", 0, (c1,), False, None)]
+            # this takes x, b to x, b + a*x mod N
+            ops += cmultmod_gates(c1, x, b, j, N, zero)
+
+            expected = (i+j*k)%N
+            passed, outp = check_batch(ops, inputs, b, expected, num_qubits)
+            for n in np.flatnonzero(~passed):
+                print("-"*10)
+                print("b = {:8b}\na = {:8b}\nN = {:8b}\n+ = {:8b} != {:8f} ({})".format(i[n], j, N, outp[n], expected[n], False))
+                all_passed = False
+    report(all_passed)
+
+def test_ua(size=3):
     print("Starting the UA test for numbers of size {}".format(size))
-    zeros = QubitPlaceholder.register(size+1)
-    x = QubitPlaceholder.register(size)
-    c1 = QubitPlaceholder()
-    zero = QubitPlaceholder()
+    zeros = list(range(size+1))
+    x = list(range(size+1, 2*size+1))
+    c1, zero = 2*size+1, 2*size+2
+    num_qubits = 2*size+3
+    k = np.arange(2**size)
     all_passed = True
     for N in range(1, 2**size):
         for j in range(0, 2**size):
-            for k in range(0, 2**size):
-                g, _, _ = egcd(j, N)
-                if g != 1 :
-                    continue
-                #assert (modinv(j, N)*j)%N == 1
-                p = Program()
-                p += get_defs()
-
-                p += write_in(k, x)
-
-                p += X(c1)
-                # this takes x, to a*x mod N
-                p += UA(c1, x, zeros, j, N, zero)
-
-                outp, prog = read_out(p, x)
-                expected = (j*k)%N
-                res = expected == outp
-                if not res:
-                    print("-"*10)
-                    print("a = {:8b}\nx = {:8b}\nN = {:8b}\n* = {:8b} != {:8f} ({})".format(j, k, N, outp, expected, res))
-                    all_passed = False
-    if not all_passed:
-        print("Uh-oh, there were errors")
-    else:
-        print("Success, all tests passed")
+            g, _, _ = egcd(j, N)
+            if g != 1 :
+                continue
+            ops = [("X", 0, (c1,), False, None)]
+            # this takes x, to a*x mod N
+            ops += ua_gates(c1, x, zeros, j, N, zero)
+
+            expected = (j*k)%N
+            passed, outp = check_batch(ops, register_index(k, x), x, expected, num_qubits)
+            for n in np.flatnonzero(~passed):
+                print("-"*10)
+                print("a = {:8b}\nx = {:8b}\nN = {:8b}\n* = {:8b} != {:8f} ({})".format(j, k[n], N, outp[n], expected[n], False))
+                all_passed = False
+    report(all_passed)
+
+# The emulator runs the same blocks on packed basis states instead of a
+# statevector, so these go to sizes the simulator can't reach, with every
+# input at once
+
+def test_cmult_emulated(size=8):
+    print("Starting the emulated CMULTMOD test for numbers of size {}".format(size))
+    b = list(range(size+1))
+    x = list(range(size+1, 2*size+1))
+    c1, zero = 2*size+1, 2*size+2
+    all_passed = True
+    for N in (2**(size-1)+1, 2**size-1):
+        i, k = [v.reshape(-1) for v in np.meshgrid(np.arange(N), np.arange(2**size))]
+        inputs = pack(i, b) | pack(k, x) | (1 << c1)
+        for j in (1, 2, N-1):
+            result = emulate(cmultmod_gates(c1, x, b, j, N, zero), inputs)
+            outp = unpack(result.bits, b)
+            expected = (i+j*k)%N
+            passed = (outp == expected) & result.ok
+            for n in np.flatnonzero(~passed)[:10]:
+                print("-"*10)
+                print("b = {:8b}\na = {:8b}\nN = {:8b}\n+ = {:8b} != {:8b}".format(i[n], j, N, outp[n], expected[n]))
+            all_passed &= bool(passed.all() and not result.phases)
+    report(all_passed)
+
+def test_ua_emulated(size=8):
+    print("Starting the emulated UA test for numbers of size {}".format(size))
+    b = list(range(size+1))
+    x = list(range(size+1, 2*size+1))
+    c1, zero = 2*size+1, 2*size+2
+    all_passed = True
+    for N in (2**(size-1)+1, 2**size-1):
+        k = np.arange(N)
+        for j in (2, N-2):
+            g, _, _ = egcd(j, N)
+            if g != 1 :
+                continue
+            result = emulate(ua_gates(c1, x, b, j, N, zero), pack(k, x) | (1 << c1))
+            outp = unpack(result.bits, x)
+            expected = (j*k)%N
+            passed = (outp == expected) & (unpack(result.bits, b) == 0) & result.ok
+            for n in np.flatnonzero(~passed)[:10]:
+                print("-"*10)
+                print("a = {:8b}\nx = {:8b}\nN = {:8b}\n* = {:8b} != {:8b}".format(j, k[n], N, outp[n], expected[n]))
+            all_passed &= bool(passed.all() and not result.phases)
+    report(all_passed)
+
+def test_oracle_peaks(N=4093*4099, a=2, shots=5000):
+    # Past about 20 bits k*Q overflows int64, so check at 24 bits that the
+    # oracle's samples sit on the peaks k*Q/r with k uniform over [0, r)
+    print("Starting the oracle peak test for N = {}".format(N))
+    size = N.bit_length()
+    Q = 1 << (2*size)
+    r = order(a, N)
+    samples = shor_samples(r, Q, shots, np.random.RandomState(0))
+    k = [(int(y)*r + Q//2) // Q % r for y in samples]
+    off = [abs(int(y) - (kk*Q + r//2) // r) for y, kk in zip(samples, k)]
+    counts = np.bincount(np.array(k) * 10 // r, minlength=10)
+    print("peaks per tenth of [0, r): {}".format(counts))
+    expected = shots / 10
+    all_passed = (max(off) <= 32 and len(set(k)) > 0.99*shots
+                  and np.all(np.abs(counts - expected) < 5*np.sqrt(expected)))
+    report(all_passed)
+
+def test_templates(size=6):
+    # The stamped templates must give exactly the ops of the generators they
+    # replace, for UA on its own and for the whole period circuit
+    print("Starting the template test for numbers of size {}".format(size))
+    layout = period_layout(size)
+    num_qubits = 2*size+3
+    all_passed = True
+    for N, a, k_max in ((15, 7, None), (21, 2, 3), (33, 5, None), (55, 2, 2)):
+        stamped = Circuit.concatenate(stamp_all(ua_stamps(layout.c1, layout.x, layout.b, a, N, layout.zero, k_max),
+                                                num_qubits), num_qubits)
+        generated = Circuit.from_ops(ua_gates(layout.c1, layout.x, layout.b, a, N, layout.zero, k_max), num_qubits)
+        all_passed &= list(stamped.ops()) == list(generated.ops())
+
+        n = N.bit_length()
+        regs = period_layout(n)
+        ops = list(write_in_gates(1, regs.x)) + list(period_gates(regs.c1, regs.x, regs.b, a, N, regs.zero, 2*n, k_max))
+        all_passed &= list(period_circuit(a, N, n, k_max=k_max).ops()) == ops
+        if not all_passed:
+            print("N = {}, a = {}, k_max = {}: templates differ".format(N, a, k_max))
+            break
+    report(all_passed)
+
+def test_optimizer(N=15, a=7, seeds=2):
+    # The peephole pass must leave the period circuit's state alone, exact
+    # and approximate QFT alike, with the same measurements drawn
+    print("Starting the optimizer test for N = {}".format(N))
+    all_passed = True
+    for k_max in (None, 3):
+        circuit = period_circuit(a, N, N.bit_length(), k_max=k_max)
+        optimized = period_circuit(a, N, N.bit_length(), optimized=True, k_max=k_max)
+        all_passed &= len(optimized) < len(circuit)
+        for seed in range(seeds):
+            state = Simulator(random_seed=seed).wavefunction(circuit)
+            if not np.allclose(state, Simulator(random_seed=seed).wavefunction(optimized)):
+                print("k_max {}, seed {}: optimized circuit differs".format(k_max, seed))
+                all_passed = False
+    report(all_passed)
+
+def test_fuse(N=15, a=7, seeds=2):
+    # Fusing must not change the period circuit's state, nor which outcomes
+    # a seeded run draws, through its measurements and conditioned gates
+    print("Starting the fusion test for N = {}".format(N))
+    circuit = period_circuit(a, N, N.bit_length(), optimized=True)
+    fused, fusion = fuse(circuit)
+    names = [op[0] for op in fused.ops()]
+    all_passed = (fusion.blocks > 0 and "MEASURE" in names
+                  and any(op[4] is not None for op in fused.ops()))
+    for seed in range(seeds):
+        state = Simulator(random_seed=seed).wavefunction(circuit)
+        fused_state = Simulator(random_seed=seed).wavefunction(fused)
+        samples = Simulator(random_seed=seed).run(circuit, trials=4)
+        fused_samples = Simulator(random_seed=seed).run(fused, trials=4)
+        if not np.allclose(state, fused_state) or not np.array_equal(samples, fused_samples):
+            print("seed {}: fused circuit differs".format(seed))
+            all_passed = False
+    report(all_passed)
+
+def test_sequential(N=15, a=7, shots=8):
+    # Running round by round with the corrections chosen from the measured
+    # bits must draw the same shots as the whole circuit with its
+    # conditioned gates, one random draw per measurement in both
+    print("Starting the sequential backend test for N = {}".format(N))
+    size = N.bit_length()
+    all_passed = True
+    for seed, k_max in ((0, None), (1, 3)):
+        rounds = PERIOD(a, N, size, SequentialBackend(random_seed=seed), shots, k_max=k_max)
+        whole = PERIOD(a, N, size, SimulatorBackend(random_seed=seed), shots, k_max=k_max)
+        if not np.array_equal(rounds, whole):
+            print("seed {}: {} != {}".format(seed, rounds, whole))
+            all_passed = False
+    report(all_passed)
+
+def test_chunked(size=8, chunk_qubits=4):
+    # A memory-mapped state goes through apply_pass, measure_chunked and
+    # sample_chunked instead of the in-memory paths, and must draw the same
+    # results for a seed. The first circuit only measures at the end, where
+    # all its trials are sampled at once, the second measures a qubit
+    # mid-circuit and conditions a gate on it.
+    print("Starting the chunked storage test for numbers of size {}".format(size))
+    reg = list(range(size))
+    qft = list(write_in_gates(5, reg)) + list(qft_gates(reg))
+    measure = [("MEASURE", i, (q,), False, None) for i, q in enumerate(reg)]
+    mid = qft[:len(qft)//2] + measure[:1] + [("X", 0, (reg[1],), False, 0)] + qft[len(qft)//2:] + measure[1:]
+    all_passed = True
+    with tempfile.TemporaryDirectory() as storage:
+        for ops in (qft + measure, mid):
+            circuit = Circuit.from_ops(ops, size, size)
+            chunked = Simulator(random_seed=0, storage=storage, chunk_qubits=chunk_qubits)
+            memory = Simulator(random_seed=0)
+            all_passed &= np.allclose(chunked.wavefunction(circuit), memory.wavefunction(circuit))
+            all_passed &= np.array_equal(chunked.run(circuit, trials=16), memory.run(circuit, trials=16))
+    report(all_passed)
+
+def test_threads(N=15, a=7):
+    # Below THREADED_MIN_QUBITS the simulator never starts its threads, so
+    # lower it to run the period circuit's passes over the blocks in parallel
+    print("Starting the threaded simulator test for N = {}".format(N))
+    circuit = period_circuit(a, N, N.bit_length(), optimized=True)
+    min_qubits = simulator.THREADED_MIN_QUBITS
+    simulator.THREADED_MIN_QUBITS = 0
+    try:
+        with Simulator(random_seed=0, threads=4) as threaded:
+            state = threaded.wavefunction(circuit)
+            samples = threaded.run(circuit, trials=4)
+            all_passed = threaded._pool is not None
+    finally:
+        simulator.THREADED_MIN_QUBITS = min_qubits
+    serial = Simulator(random_seed=0)
+    all_passed &= np.allclose(state, serial.wavefunction(circuit))
+    all_passed &= np.array_equal(samples, serial.run(circuit, trials=4))
+    report(all_passed)
+
+def test_classical_batches(trials=200):
+    # cfBatch and checkCandidatesBatch against the one-at-a-time cf and
+    # checkCandidates below, the originals they replaced. A small
+    # CHECK_CHUNK makes candidates span several chunks.
+    print("Starting the batched classical test")
+    rng = random.Random(0)
+    all_passed = True
+    for N in (15, 221, 4093*4099, (2**31-1)*(2**61-1)):
+        Q = 1 << (2*N.bit_length())
+        ys = [rng.randrange(Q) for _ in range(trials)]
+        if list(cfBatch(ys, Q, N)) != [cf(y, Q, N) for y in ys]:
+            print("cfBatch differs from cf for N = {}".format(N))
+            all_passed = False
+    check_chunk = shors.CHECK_CHUNK
+    shors.CHECK_CHUNK = 3
+    try:
+        for _ in range(trials):
+            N = rng.choice((15, 21, 91, 221, 1001, 3127))
+            a = rng.randrange(2, N)
+            if egcd(a, N)[0] != 1:
+                continue
+            neighborhood = rng.randrange(6)
+            rs = [rng.randrange(N) for _ in range(rng.randrange(1, 8))]
+            expected = [checkCandidates(a, r, N, neighborhood) for r in rs]
+            if list(checkCandidatesBatch(a, rs, N, neighborhood)) != [-1 if r is None else r for r in expected]:
+                print("checkCandidatesBatch differs for N = {}, a = {}, rs = {}".format(N, a, rs))
+                all_passed = False
+    finally:
+        shors.CHECK_CHUNK = check_chunk
+    report(all_passed)
+
+def test_prescreen():
+    # The classical checks shors runs before building any circuit
+    print("Starting the classical pre-screening test")
+    all_passed = (trialDivision(91, 10) == 7 and trialDivision(91, 6) is None
+                  and trialDivision(4093, 4093) is None)
+    for N in (49, 125, 2187, 1024, 1331**2):
+        b = perfectPower(N)
+        all_passed &= b is not None and any(b**k == N for k in range(2, N.bit_length() + 1))
+    for N in (15, 221, 4093*4099):
+        all_passed &= perfectPower(N) is None
+    all_passed &= preScreen(22) == [2, 11] and preScreen(343) == [7, 49]
+    all_passed &= preScreen(91, trialBound=10) == [7, 13] and preScreen(91) is None
+    factors = preScreen(4093*4099, rhoBudget=10000)
+    all_passed &= factors is not None and sorted(factors) == [4093, 4099]
+    # A prime is reported as its own factorization, distinct from a failure
+    all_passed &= shors.shors(4093) == [4093] and shors.shors(2) is False
+    report(all_passed)
+
+# The one-at-a-time continued fractions and candidate check shors.py used
+# before batching, kept to check the batched versions against
+
+# Extended Euclidean
+def extendedGCD(a, b):
+    fractions = []
+    while b != 0:
+        fractions.append(a // b)
+        tA = a % b
+        a = b
+        b = tA
+
+    return fractions
+
+# Continued Fractions
+def cf(y, Q, N):
+    fractions = extendedGCD(y, Q)
+    depth = 2
+
+    def partial(fractions, depth):
+        c = 0
+        r = 1
+
+        for i in reversed(range(depth)):
+            tR = fractions[i] * r + c
+            c = r
+            r = tR
+
+        return c
+
+    r = 0
+    for d in range(depth, len(fractions) + 1):
+        tR = partial(fractions, d)
+        if tR == r or tR >= N:
+            return r
+
+        r = tR
+
+    return r
+
+def checkCandidates(a, r, N, neighborhood):
+    if r is None:
+        return None
+
+    # Check multiples
+    for k in range(1, neighborhood + 2):
+        tR = k * r
+        if modExp(a, a, N) == modExp(a, a + tR, N):
+            return tR
+
+    # Check lower neighborhood
+    for tR in range(r - neighborhood, r):
+        if modExp(a, a, N) == modExp(a, a + tR, N):
+            return tR
+
+    # Check upper neigborhood
+    for tR in range(r + 1, r + neighborhood + 1):
+        if modExp(a, a, N) == modExp(a, a + tR, N):
+            return tR
+
+    return None
 
 def egcd(a, b):
     if a == 0:
@@ -1,4 +1,4 @@
-from final2 import phase_helper
+from resources import estimate
 from IPython import embed
 
 import pickle
@@ -17,9 +17,10 @@ def main():
     f = open("jar/gates.pickle", "bw")
     for i, x in enumerate(muls):
         print("{} : {} bits".format(x, bits[i]))
-        p = phase_helper(3, x, bits[i])
-        num_gates = len(p.instructions)
-        num_qubits = len(p.get_qubits())
+        # Counted from the circuit structure, nothing is built
+        e = estimate(3, x, bits[i])
+        num_gates = e.instructions
+        num_qubits = e.qubits
         gates.append(num_gates)
         qubits.append(num_qubits)
         print("{} gates".format(num_gates))